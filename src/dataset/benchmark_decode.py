@@ -0,0 +1,69 @@
+import os
+import time
+import argparse
+
+from .dataset import MakeupDataset2
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATASET_DIR = os.path.join(FILE_DIR, "data", "instagram")
+
+
+def warm_page_cache(paths):
+    """
+    Read the files once, so that both decoding paths read them from the page cache.
+    """
+    for path in paths:
+        with open(path, "rb") as f:
+            f.read()
+
+
+def benchmark_decode(dataset, num_images):
+    """
+    Measure how many images per second the dataset decodes and resizes.
+
+    Args:
+        dataset: The MakeupDataset to benchmark.
+        num_images: Number of images to decode.
+
+    Returns:
+        The number of images decoded per second.
+    """
+
+    paths = (dataset.images_before + dataset.images_after)[:num_images]
+
+    start_time = time.perf_counter()
+    for path in paths:
+        dataset.decode_image(path)
+
+    return len(paths) / (time.perf_counter() - start_time)
+
+
+def main(args):
+    print("Benchmarking decoding of {} images at size {}...".format(args.num_images, args.image_size))
+
+    for fast_decode in (False, True):
+        dataset = MakeupDataset2(args.dataset_dir, image_size=args.image_size, fast_decode=fast_decode)
+        warm_page_cache((dataset.images_before + dataset.images_after)[:args.num_images])
+        images_per_sec = benchmark_decode(dataset, args.num_images)
+
+        name = "draft + resize" if fast_decode else "convert + resize"
+        print("{:>20}: {:8.1f} images/sec".format(name, images_per_sec))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Compare full and reduced-resolution (JPEG draft) decoding of MakeupDataset2.")
+
+    parser.add_argument("--dataset_dir", type=str, default=DATASET_DIR,
+        help="directory of the dataset containing the 'makeup' and 'nomakeup' directories.")
+    parser.add_argument("--image_size", type=int, default=64,
+        help="size at which images are decoded.")
+    parser.add_argument("-n", "--num_images", type=int, default=1000,
+        help="number of images decoded in each benchmark.")
+
+    args = parser.parse_args()
+
+    main(args)
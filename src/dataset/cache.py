@@ -0,0 +1,122 @@
+import multiprocessing
+import torch
+
+
+class SharedImageCache:
+    """
+    A cache of decoded images of a fixed size, bounded by a byte budget and kept in shared
+    memory so that it is visible to all DataLoader workers (create it before the workers start).
+    When the cache is full, images are evicted with CLOCK (an approximation of LRU).
+    """
+
+    def __init__(self, num_keys, image_size, max_bytes, image_channels=3):
+        """
+        Initializes SharedImageCache.
+
+        Args:
+            num_keys: Number of images that could be cached (keys are in range(num_keys)).
+            image_size: The images are of size (image_size x image_size).
+            max_bytes: The budget in bytes of the cached images.
+            image_channels: Number of channels of the images.
+        """
+
+        image_shape = [image_size, image_size, image_channels]
+        image_bytes = image_size * image_size * image_channels
+        num_slots = min(num_keys, max_bytes // image_bytes)
+
+        self.max_bytes = max_bytes
+        self.num_slots = num_slots
+
+        # All state lives in shared tensors, guarded by one inter-process lock
+        self.images = torch.zeros([num_slots] + image_shape, dtype=torch.uint8).share_memory_()
+        self.slot_of_key = torch.full([num_keys], -1, dtype=torch.int64).share_memory_()
+        self.key_of_slot = torch.full([num_slots], -1, dtype=torch.int64).share_memory_()
+        self.referenced = torch.zeros([num_slots], dtype=torch.bool).share_memory_()
+        self.clock = torch.zeros([1], dtype=torch.int64).share_memory_()
+        self.hits = torch.zeros([1], dtype=torch.int64).share_memory_()
+        self.misses = torch.zeros([1], dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+
+    def get(self, key):
+        """
+        Get the cached image of `key`.
+
+        Args:
+            key: The key of the image.
+
+        Returns:
+            A copy of the image as a uint8 numpy array, or None if it is not cached.
+        """
+
+        with self.lock:
+            slot = self.slot_of_key[key].item()
+            if slot < 0:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.referenced[slot] = True
+            return self.images[slot].numpy().copy()
+
+
+    def put(self, key, image):
+        """
+        Cache the image of `key`, evicting another image if the cache is full.
+
+        Args:
+            key: The key of the image.
+            image: The image as a uint8 numpy array of size (image_size x image_size x image_channels).
+        """
+
+        if self.num_slots == 0:
+            return
+
+        with self.lock:
+            if self.slot_of_key[key].item() >= 0:
+                return  # cached by another worker in the meantime
+
+            slot = self._evict()
+            self.images[slot] = torch.from_numpy(image)
+            self.key_of_slot[slot] = key
+            self.slot_of_key[key] = slot
+            self.referenced[slot] = True
+
+
+    def _evict(self):
+        """
+        Free a slot with the CLOCK algorithm (must hold the lock).
+        The clock hand skips (and clears) recently referenced slots.
+
+        Returns:
+            The freed slot.
+        """
+
+        while True:
+            slot = self.clock.item()
+            self.clock[0] = (slot + 1) % self.num_slots
+
+            old_key = self.key_of_slot[slot].item()
+            if old_key < 0:
+                return slot  # empty slot
+            if not self.referenced[slot]:
+                self.slot_of_key[old_key] = -1
+                self.key_of_slot[slot] = -1
+                return slot
+
+            self.referenced[slot] = False
+
+
+    def hit_rate(self):
+        """
+        Returns the ratio of cache hits to all lookups so far.
+        """
+        hits, misses = self.hits.item(), self.misses.item()
+        return hits / (hits + misses) if hits + misses > 0 else 0.0
+
+
+    def __repr__(self):
+        num_cached = (self.key_of_slot >= 0).sum().item()
+        return "{}(cached={}/{}, hits={}, misses={}, hit_rate={:.3f})".format(
+            self.__class__.__name__, num_cached, self.num_slots,
+            self.hits.item(), self.misses.item(), self.hit_rate())
@@ -0,0 +1,105 @@
+import os
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+from utility import files_iter
+from extract_faces import detect_landmarks
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+### NOTE: we assume that all visible files in source dir are images ###
+SOURCE_DIR = os.path.join(FILE_DIR, "processing", "splits")
+
+
+def landmarks_array(landmarks):
+    return np.array([p for ps in landmarks.values() for p in ps], dtype=np.float64)
+
+
+def normalized_error(landmarks, reference):
+    """
+    Compute the mean distance between landmarks and reference landmarks,
+    normalized by the distance between the eyes of the reference.
+    """
+    left_eye = np.mean(reference["left_eye"], axis=0)
+    right_eye = np.mean(reference["right_eye"], axis=0)
+    distances = np.linalg.norm(landmarks_array(landmarks) - landmarks_array(reference), axis=1)
+    return distances.mean() / np.linalg.norm(right_eye - left_eye)
+
+
+def time_detection(image, max_side=None, refine=False):
+    """
+    Detect the landmarks of an image and time it.
+
+    Returns:
+        The landmarks (None if no face was detected) and the detection time in seconds.
+    """
+    start_time = time.perf_counter()
+    try:
+        landmarks = detect_landmarks(image, max_side, refine)
+    except Exception:
+        landmarks = None
+    return landmarks, time.perf_counter() - start_time
+
+
+def benchmark_detection(source_dir, max_sides, num_images=100):
+    """
+    Compare the time and the accuracy of landmarks detection on images downscaled to
+    different longest sides (caps), with and without refinement at full resolution.
+    The landmarks detected at full resolution are the reference.
+
+    Args:
+        source_dir: Directory of source images.
+        max_sides: The caps of the longest side of the images.
+        num_images: Number of images of the benchmark.
+    """
+
+    images = []
+    for file_name in sorted(files_iter(source_dir))[:num_images]:
+        with Image.open(os.path.join(source_dir, file_name)) as image:
+            images.append(image.convert("RGB"))
+
+    print("Detecting reference landmarks of {} images at full resolution...".format(len(images)))
+    references, times = zip(*(time_detection(image) for image in images))
+    images_sides = [max(image.size) for image in images]
+    print("Median longest side: {:.0f}, mean time: {:.1f} ms".format(np.median(images_sides), 1000 * np.mean(times)))
+
+    print("{:>8} {:>7} {:>10} {:>9} {:>9}".format("max side", "refine", "time (ms)", "detected", "error"))
+    for max_side in max_sides:
+        for refine in (False, True):
+            errors, times, detected = [], [], 0
+            for image, reference in zip(images, references):
+                landmarks, elapsed = time_detection(image, max_side, refine)
+                times.append(elapsed)
+                if landmarks is None:
+                    continue
+                detected += 1
+                if reference is not None:
+                    errors.append(normalized_error(landmarks, reference))
+
+            error = np.mean(errors) if errors else float("nan")
+            print("{:>8} {:>7} {:>10.1f} {:>9} {:>9.4f}".format(
+                max_side, str(refine), 1000 * np.mean(times), "{}/{}".format(detected, len(images)), error))
+
+
+def main(args):
+    benchmark_detection(args.source_dir, args.max_sides, args.num_images)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="benchmark landmarks detection time and accuracy for detection resolution caps.")
+
+    parser.add_argument('--source_dir', type=str, default=SOURCE_DIR,
+        help="source directory of the images of the benchmark.")
+    parser.add_argument('--max_sides', type=int, nargs="+", default=[320, 480, 640, 800, 1024],
+        help="caps of the longest side of the images on which faces are detected.")
+    parser.add_argument('-n', '--num_images', type=int, default=100,
+        help="number of images of the benchmark.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,13 +1,21 @@
 
+import io
 import os
+import time
 import argparse
 import pickle
+import functools
+import contextlib
+import multiprocessing
+from collections import Counter
 import cv2
 import numpy as np
 import face_recognition
 from PIL import Image, ImageDraw
 
 from utility import files_iter
+from pyramid import save_pyramid
+from work_queue import WorkQueue, drain
 
 
 # Get absolute path and force relative-to-file paths
@@ -17,6 +25,15 @@ FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 SOURCE_DIR = os.path.join(FILE_DIR, "processing", "splits")
 DEST_DIR = os.path.join(FILE_DIR, "processing", "faces")
 
+# Default thresholds of the pre-screen of images before face detection
+PRESCREEN = {
+    "min_side": 64,  # min length of the shorter side, in pixels
+    "max_aspect": 3.0,  # max ratio of the longer side to the shorter side
+    "min_sharpness": 20.0,  # min variance of the Laplacian of the grayscale image (blur score)
+    "min_contrast": 8.0,  # min standard deviation of the grayscale image (near-uniform content)
+}
+PRESCREEN_SIDE = 512  # sharpness and contrast are measured on a copy downscaled to this longest side
+
 
 #################### FACES ####################
 
@@ -28,41 +45,170 @@ def centroid(points):
     return round(xc), round(yc)
 
 
-def align_eyes_horizontally(face_img):
-    landmarks = face_recognition.face_landmarks(np.array(face_img))
-    if len(landmarks) == 0: raise Exception(" Couldn't extract any faces.")
+def prescreen(image, min_side=PRESCREEN["min_side"], max_aspect=PRESCREEN["max_aspect"],
+              min_sharpness=PRESCREEN["min_sharpness"], min_contrast=PRESCREEN["min_contrast"]):
+    """
+    Cheaply check whether an image could be a useful face, before paying for face detection.
 
-    left_eye = centroid(landmarks[0]["left_eye"])
-    right_eye = centroid(landmarks[0]["right_eye"])
-    h = right_eye[1] - left_eye[1]
-    w = right_eye[0] - left_eye[0]
-    angle = np.arcsin(h / np.sqrt(h*h + w*w)) * 180.0 / np.pi
+    Args:
+        image: The image in PIL format.
+        min_side: Reject images whose shorter side is shorter than this.
+        max_aspect: Reject images whose ratio of longer to shorter side is larger than this.
+        min_sharpness: Reject (blurry) images whose variance of the Laplacian is lower than this.
+        min_contrast: Reject (near-uniform) images whose standard deviation is lower than this.
+
+    Returns:
+        None if the image passes, otherwise the reason of the rejection and its details.
+    """
+
+    w, h = image.size
+    if min(w, h) < min_side:
+        return "too small", "{}x{} < {}".format(w, h, min_side)
+    if max(w, h) / min(w, h) > max_aspect:
+        return "bad aspect ratio", "{:.2f} > {}".format(max(w, h) / min(w, h), max_aspect)
+
+    gray = np.asarray(image.convert("L"))
+    scale = PRESCREEN_SIDE / max(w, h)
+    if scale < 1:
+        gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    contrast = gray.std()
+    if contrast < min_contrast:
+        return "near-uniform", "contrast {:.1f} < {}".format(contrast, min_contrast)
+    sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+    if sharpness < min_sharpness:
+        return "blurry", "sharpness {:.1f} < {}".format(sharpness, min_sharpness)
+
+    return None
+
+
+def detect_landmarks(face_img, max_side=None, refine=False):
+    """
+    Detect the landmarks of the first face in an image.
+
+    Args:
+        face_img: The image in PIL format.
+        max_side: Detect faces on a copy of the image downscaled to this longest side (if larger),
+                  and map the landmarks back to the image. HOG detection dominates the cost of
+                  landmarks detection, and scales with the number of pixels.
+        refine: Predict the landmarks at full resolution, in the box of the face detected on the
+                downscaled copy, instead of mapping the landmarks predicted on the copy.
+
+    Returns:
+        The landmarks as a dict of {"part": [points, ...]}.
+    """
+
+    image = np.array(face_img)
+    scale = max_side / max(face_img.size) if max_side else 1
+    if scale >= 1:
+        landmarks = face_recognition.face_landmarks(image)
+        if len(landmarks) == 0: raise Exception(" Couldn't extract any faces.")
+        return landmarks[0]
+
+    size = (round(face_img.width * scale), round(face_img.height * scale))
+    small_image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    face_locations = face_recognition.face_locations(small_image)
+    if len(face_locations) == 0: raise Exception(" Couldn't extract any faces.")
+
+    if refine:
+        face_location = tuple(round(x / scale) for x in face_locations[0])  # (top, right, bottom, left)
+        landmarks = face_recognition.face_landmarks(image, [face_location])
+        return landmarks[0]
+
+    landmarks = face_recognition.face_landmarks(small_image, face_locations[:1])
+    return map_landmarks(landmarks[0], lambda x, y: (x / scale, y / scale))
 
-    return face_img.rotate(angle)
 
+def map_landmarks(landmarks, f):
+    """Map the (x, y) points of the landmarks (a dict of {"part": [points, ...]}) with `f`."""
+    return {part: [f(x, y) for x, y in points] for part, points in landmarks.items()}
 
-def zoom_on_face(face_img, scale=1.2):
-    landmarks = face_recognition.face_landmarks(np.array(face_img))
-    if len(landmarks) == 0: raise Exception(" Couldn't extract any faces.")
 
-    landmarks_list = [x for xs in landmarks[0].values() for x in xs]
-    x, y, w, h = cv2.boundingRect(np.array(landmarks_list))
+def round_landmarks(landmarks):
+    return map_landmarks(landmarks, lambda x, y: (int(round(x)), int(round(y))))
+
+
+def alignment_matrix(landmarks, scale=1.2):
+    """
+    Compute the similarity transform (rotation + crop) of an aligned face: the image is rotated
+    so that the eyes are horizontal, and cropped around the bounding box of the landmarks.
+
+    Args:
+        landmarks: The landmarks of the face in the image.
+        scale: The scale of the crop relative to the bounding box of the landmarks.
+
+    Returns:
+        The 2x3 affine matrix from the image to the face, and the size (width, height) of the face.
+    """
+
+    left_eye = centroid(landmarks["left_eye"])
+    right_eye = centroid(landmarks["right_eye"])
+    h = right_eye[1] - left_eye[1]
+    w = right_eye[0] - left_eye[0]
+    angle = np.arcsin(h / np.sqrt(h*h + w*w))
+
+    # Rotation that makes the eyes horizontal (counterclockwise, with y pointing down)
+    cos, sin = np.cos(angle), np.sin(angle)
+    rotation = np.array([[cos, sin], [-sin, cos]])
+
+    # Bounding box of the rotated landmarks (inclusive, as cv2.boundingRect), zoomed out by scale
+    points = np.array([p for ps in landmarks.values() for p in ps], dtype=np.float64) @ rotation.T
+    (x, y), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+    w, h = x_max - x + 1, y_max - y + 1
     y -= (scale - 1) * 0.7 * h
     x -= (scale - 1) * 0.5 * w
     h *= scale
     w *= scale
 
-    return face_img.crop((x, y, x+w, y+h))
+    matrix = np.hstack([rotation, [[-x], [-y]]])
+    return matrix, (int(round(w)), int(round(h)))
+
+
+def align_face(image, landmarks, face_size=None):
+    """
+    Align and crop the face of an image with one affine warp, and map its landmarks to the face.
+
+    Args:
+        image: The image in PIL format.
+        landmarks: The landmarks of the face in the image.
+        face_size: Resize the face to (face_size x face_size), if given.
+
+    Returns:
+        The face image and its landmarks.
+    """
+
+    matrix, (w, h) = alignment_matrix(landmarks)
+    face = cv2.warpAffine(np.asarray(image), matrix, (w, h), flags=cv2.INTER_LINEAR)
+    landmarks = map_landmarks(landmarks, lambda x, y: tuple(matrix @ (x, y, 1)))
+
+    # Resize the (cropped) face, which is much cheaper than warping the image again
+    if face_size:
+        sx, sy = face_size / w, face_size / h
+        interpolation = cv2.INTER_AREA if sx * sy < 1 else cv2.INTER_LINEAR
+        face = cv2.resize(face, (face_size, face_size), interpolation=interpolation)
+        landmarks = map_landmarks(landmarks, lambda x, y: (x * sx, y * sy))
+
+    return Image.fromarray(face), landmarks
 
 
-def extract_face(file_name, source_dir, dest_dir):
+def extract_face(file_name, source_dir, dest_dir, pyramid_sizes=(), landmarks_dir=None, face_size=None,
+                 detect_max_side=None, refine=False, prescreen_thresholds=None):
     """
     Extract the first detected face from the image in `file_name` and save it.
+    Landmarks are detected once, on the source image, and mapped through the
+    alignment and the crop of the face.
 
     Args:
         file_name: The name of the file (image).
         source_dir: Directory of source images.
         dest_dir: Directory where processed images will be saved.
+        pyramid_sizes: Also save the face at these resolutions (see pyramid.py), if any.
+        landmarks_dir: Also save the landmarks of the face in this directory, if given.
+        face_size: Save the face at (face_size x face_size), if given, instead of its cropped size.
+        detect_max_side: Detect the face on a copy of the image downscaled to this longest side, if given.
+        refine: Refine the landmarks at full resolution, if the face is detected on a downscaled copy.
+        prescreen_thresholds: Pre-screen the image with these thresholds (see `prescreen`) before
+                              detecting its face, if given.
 
     Returns:
         The name of the face image.
@@ -78,17 +224,82 @@ def extract_face(file_name, source_dir, dest_dir):
         #image = face_recognition.load_image_file(source_path)
         face_img = Image.open(source_path).convert("RGB")
 
-        face_img = align_eyes_horizontally(face_img)
-        face_img = zoom_on_face(face_img)
+        # Reject implausible images before the (expensive) face detection
+        if prescreen_thresholds is not None:
+            rejection = prescreen(face_img, **prescreen_thresholds)
+            if rejection is not None:
+                print("({})".format(rejection[1]), end=" ")
+                raise Exception(" Rejected by pre-screen: {}.".format(rejection[0]))
+
+        landmarks = detect_landmarks(face_img, detect_max_side, refine)
+        face_img, landmarks = align_face(face_img, landmarks, face_size)
+
+        # Save the landmarks before the face, so that a face is never saved without its landmarks
+        if landmarks_dir is not None:
+            save_landmarks(round_landmarks(landmarks), face_img.size, face_image_name, landmarks_dir)
 
         # Crop image and save as PIL
         face_img.save(face_image_path)
 
+        # Save the face at a pyramid of resolutions
+        if pyramid_sizes:
+            save_pyramid(face_img, face_image_name, dest_dir, pyramid_sizes)
+
     print("Done.")
     return face_image_name
 
 
-def extract_faces(source_dir, faces_dir, with_landmarks=True, ensure_pairs=True):
+def try_extract_face(file_name, source_dir, faces_dir, with_landmarks=True, pyramid_sizes=(), face_size=None,
+                     detect_max_side=None, refine=False, prescreen_thresholds=None):
+    """
+    Try to extract the face (and landmarks) of one image, capturing what is printed meanwhile,
+    so that the output of images processed in parallel isn't interleaved.
+
+    Args:
+        file_name: The name of the file (image).
+        source_dir: Directory of source images.
+        faces_dir: Directory where face images will be saved.
+        with_landmarks: Extract faces landmarks as well
+        pyramid_sizes: Also save the face at these resolutions, if any.
+        face_size: Save the face at (face_size x face_size), if given.
+        detect_max_side: Detect the face on a copy of the image downscaled to this longest side, if given.
+        refine: Refine the landmarks at full resolution, if the face is detected on a downscaled copy.
+        prescreen_thresholds: Pre-screen the image with these thresholds before detecting its face, if given.
+
+    Returns:
+        The error message (None if successful) and the output of the extraction.
+    """
+
+    error = None
+    output = io.StringIO()
+    landmarks_dir = os.path.join(faces_dir, "landmarks") if with_landmarks else None
+    with contextlib.redirect_stdout(output):
+        try:
+            face_image_name = extract_face(file_name, source_dir, faces_dir, pyramid_sizes, landmarks_dir, face_size,
+                                           detect_max_side, refine, prescreen_thresholds)
+
+            # Extract landmarks of faces extracted previously without them, if needed
+            if with_landmarks:
+                extract_landmarks(face_image_name, faces_dir, landmarks_dir)
+
+        except Exception as e:
+            error = str(e).strip()
+            print("Failed."); print(f"  {error}")
+
+    return error, output.getvalue()
+
+
+def init_worker():
+    """
+    Initializes a worker process of `extract_faces`. The face_recognition models are loaded
+    once per worker (on import), rather than once per image as with extract_faces_parallel.sh.
+    """
+    cv2.setNumThreads(1)  # the workers already use all cores
+
+
+def extract_faces(source_dir, faces_dir, with_landmarks=True, ensure_pairs=True, pyramid_sizes=(),
+                  workers=1, log_path=None, face_size=None, detect_max_side=None, refine=False,
+                  prescreen_thresholds=None, queue_dir=None):
     """
     Try to extract faces from the images in source_dir and save them to faces_dir.
 
@@ -97,6 +308,15 @@ def extract_faces(source_dir, faces_dir, with_landmarks=True, ensure_pairs=True)
         faces_dir: Directory where face images will be saved.
         with_landmarks: Extract faces landmarks as well
         ensure_pairs: Ensure only paired images by removing unpaired ones.
+        pyramid_sizes: Also save the faces at these resolutions, if any.
+        workers: Number of worker processes extracting faces in parallel.
+        log_path: Path of a log file where the output of all images is written as well, if given.
+        face_size: Save the faces at (face_size x face_size), if given, instead of their cropped size.
+        detect_max_side: Detect faces on copies of the images downscaled to this longest side, if given.
+        refine: Refine the landmarks at full resolution, if faces are detected on downscaled copies.
+        prescreen_thresholds: Pre-screen the images with these thresholds before detecting their faces, if given.
+        queue_dir: Directory of a work queue shared with other nodes (see `WorkQueue`), if given. The nodes
+                   share the images, and the one that finishes last cleans up.
     """
 
     landmarks_dir = os.path.join(faces_dir, "landmarks")
@@ -105,19 +325,60 @@ def extract_faces(source_dir, faces_dir, with_landmarks=True, ensure_pairs=True)
     if not os.path.isdir(faces_dir): os.mkdir(faces_dir)
     if with_landmarks and not os.path.isdir(landmarks_dir): os.mkdir(landmarks_dir)
 
-    for file_name in files_iter(source_dir):
-        # Try to extract face from file (image)
-        try:
-            face_image_name = extract_face(file_name, source_dir, faces_dir)
-            
-            # Extract landmarks if needed
-            if with_landmarks:
-                extract_landmarks(face_image_name, faces_dir, landmarks_dir)
-
-        except Exception as e:
-            print("Failed."); print(f"  {str(e)}")
-
-    # Delete useless files
+    file_names = list(files_iter(source_dir))
+    extract = functools.partial(try_extract_face, source_dir=source_dir, faces_dir=faces_dir,
+                                with_landmarks=with_landmarks, pyramid_sizes=pyramid_sizes, face_size=face_size,
+                                detect_max_side=detect_max_side, refine=refine,
+                                prescreen_thresholds=prescreen_thresholds)
+
+    work_queue = None
+    if queue_dir is not None:
+        work_queue = WorkQueue(queue_dir)
+        work_queue.populate(file_names)
+
+    start_time = time.time()
+    errors = Counter()
+    num_images = 0
+    log = open(log_path, "w") if log_path else None
+    pool = None
+    results = None
+
+    def write(output):
+        print(output, end="")
+        if log is not None: log.write(output)
+
+    try:
+        if work_queue is not None:
+            # Claim images from the queue until all the nodes are done
+            results = drain(work_queue, extract, workers, init_worker)
+        elif workers > 1:
+            # Send images in chunks, and stream results back as they are done
+            chunksize = max(1, min(16, len(file_names) // (4 * workers)))
+            pool = multiprocessing.Pool(workers, initializer=init_worker)
+            results = pool.imap_unordered(extract, file_names, chunksize)
+        else:
+            results = map(extract, file_names)
+
+        for error, output in results:
+            write(output)
+            num_images += 1
+            if error is not None: errors[error] += 1
+
+        # Summarize
+        elapsed = time.time() - start_time
+        write("Extracted faces from {}/{} images in {:.1f}s ({:.2f} images/sec).\n".format(
+            num_images - sum(errors.values()), num_images, elapsed, num_images / max(elapsed, 1e-9)))
+        for error, count in errors.most_common():
+            write("  {:6d} x {}\n".format(count, error))
+
+    finally:
+        if work_queue is not None and results is not None: results.close()
+        if pool is not None: pool.terminate()
+        if log is not None: log.close()
+
+    # Delete useless files (once all the nodes are done)
+    if work_queue is not None and not work_queue.claim_once("clean"):
+        return
     if ensure_pairs: clean_incomplete_face_pairs(faces_dir)
     if with_landmarks: clean_landmarks(faces_dir, landmarks_dir)
 
@@ -151,7 +412,8 @@ def clean_incomplete_face_pairs(faces_dir):
 
 def extract_landmarks(file_name, source_dir, dest_dir):
     """
-    Extract the first detected face from the image in `file_name` and save it.
+    Extract the landmarks of the first detected face in the image `file_name` and save them.
+    Faces extracted by `extract_face` with a landmarks directory already have their landmarks.
 
     Args:
         file_name: The path to the face image
@@ -176,19 +438,32 @@ def extract_landmarks(file_name, source_dir, dest_dir):
         if len(face_landmarks) == 0:
             raise Exception(" Couldn't extract any landmarks.")
 
-        # Draw landmarks on an empty PIL image
-        landmarks_image = Image.new("RGB", face_image.size)
-        draw_landmarks(landmarks_image, face_landmarks[0])
+        save_landmarks(face_landmarks[0], face_image.size, file_name, dest_dir)
 
-        # Save landmarks
-        landmarks_image.save(os.path.join(dest_dir, landmarks_name))
+    return landmarks_name
 
-        # Pickle landmarks
-        landmarks_path = os.path.join(dest_dir, os.path.splitext(landmarks_name)[0] + ".pickle")
-        with open(landmarks_path, "wb") as f:
-            pickle.dump(face_landmarks[0], f)
 
-    return landmarks_name
+def save_landmarks(landmarks, image_size, file_name, dest_dir):
+    """
+    Save the landmarks of the face image `file_name`, drawn on an empty image and pickled.
+
+    Args:
+        landmarks: A dict of the landmarks coordinates, as in {"part": [coords, ...]}.
+        image_size: The size of the face image.
+        file_name: The name of the face image.
+        dest_dir: Directory where the landmarks will be saved.
+    """
+
+    landmarks_name = file_name.split(".")[0]
+
+    # Pickle landmarks first, since the drawn landmarks mark the landmarks as extracted
+    with open(os.path.join(dest_dir, landmarks_name + ".pickle"), "wb") as f:
+        pickle.dump(landmarks, f)
+
+    # Draw landmarks on an empty PIL image and save it
+    landmarks_image = Image.new("RGB", image_size)
+    draw_landmarks(landmarks_image, landmarks)
+    landmarks_image.save(os.path.join(dest_dir, landmarks_name + ".png"))
 
 
 def draw_landmarks(landmarks_image, landmarks, fill=None, width=3):
@@ -233,11 +508,29 @@ def clean_landmarks(faces_dir, landmarks_dir):
 #################### END LANDMARKS ####################
 
 
+def add_prescreen_arguments(parser):
+    """Add the arguments of the pre-screen to an argument parser."""
+    parser.add_argument("--prescreen", action="store_true",
+        help="reject small, stretched, blurry and near-uniform images before face detection")
+    for name, value in PRESCREEN.items():
+        parser.add_argument("--" + name, type=type(value), default=value,
+            help="pre-screen threshold (see `prescreen`)")
+
+
+def prescreen_thresholds_of(args):
+    return {name: getattr(args, name) for name in PRESCREEN} if args.prescreen else None
+
+
 def main(args):
     if args.image:
-        extract_face(args.image, args.source_dir, args.dest_dir)
+        landmarks_dir = os.path.join(args.dest_dir, "landmarks") if args.with_landmarks else None
+        if landmarks_dir is not None and not os.path.isdir(landmarks_dir): os.makedirs(landmarks_dir)
+        extract_face(args.image, args.source_dir, args.dest_dir, args.pyramid_sizes, landmarks_dir, args.face_size,
+                     args.detect_max_side, args.refine, prescreen_thresholds_of(args))
     else:
-        extract_faces(args.source_dir, args.dest_dir, args.with_landmarks, args.ensure_pairs)
+        extract_faces(args.source_dir, args.dest_dir, args.with_landmarks, args.ensure_pairs,
+                      args.pyramid_sizes, args.workers, args.log, args.face_size, args.detect_max_side, args.refine,
+                      prescreen_thresholds_of(args), args.queue_dir)
 
 
 if __name__ == '__main__':
@@ -254,6 +547,21 @@ if __name__ == '__main__':
         help="extract faces landmarks as well")
     parser.add_argument("--ensure_pairs", action="store_true",
         help="ensure only paired images (remove images with no corresponding paired image)")
+    parser.add_argument("--pyramid_sizes", type=int, nargs="*", default=[],
+        help="also save faces at these resolutions (e.g. 32 64 128 256) for low-resolution training")
+    parser.add_argument("--face_size", type=int, default=None,
+        help="save faces at this (square) training resolution instead of their cropped size")
+    parser.add_argument("--detect_max_side", type=int, default=None,
+        help="detect faces on copies of the images downscaled to this longest side (e.g. 640)")
+    parser.add_argument("--refine", action="store_true",
+        help="refine the landmarks at full resolution when detecting on downscaled copies")
+    add_prescreen_arguments(parser)
+    parser.add_argument("-w", "--workers", type=int, default=1,
+        help="number of worker processes extracting faces in parallel")
+    parser.add_argument("--log", type=str, default=None,
+        help="path of a log file where the output of all images is written as well")
+    parser.add_argument("--queue_dir", type=str, default=None,
+        help="directory of a work queue (on a shared volume) to share the images with other nodes running the same command")
     
     args = parser.parse_args()
 
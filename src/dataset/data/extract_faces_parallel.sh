@@ -1,9 +1,11 @@
+
 SOURCE_DIR=${1:-"instagram/test_images"}
 DEST_DIR=${2:-"instagram/test_faces"}
 LOG="extract_faces.log"
 
 mkdir -p "$DEST_DIR"
-rm -f "$LOG"
 
-time (find "$SOURCE_DIR" -maxdepth 1 -type f -exec basename {} \; \
-| parallel --bar "python extract_faces.py --source_dir $SOURCE_DIR --dest_dir $DEST_DIR --image {} 1>>$LOG 2>&1")
\ No newline at end of file
+# One worker process per core, each loading the face_recognition models once
+time python extract_faces.py --source_dir "$SOURCE_DIR" --dest_dir "$DEST_DIR" \
+    --workers "$(getconf _NPROCESSORS_ONLN)" --log "$LOG" > /dev/null
+tail -n 20 "$LOG"
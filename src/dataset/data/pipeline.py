@@ -0,0 +1,428 @@
+import io
+import os
+import sys
+import json
+import subprocess
+import time
+import queue
+import shutil
+import hashlib
+import argparse
+import threading
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from utility import files_iter
+from split_images import split_image
+from extract_faces import extract_face, extract_landmarks, init_worker, add_prescreen_arguments, prescreen_thresholds_of
+from pyramid import PYRAMID_DIR
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# The landmarks store and the packed images are built by the scripts of the dataset directory, one directory up
+DATASET_SCRIPTS_DIR = os.path.dirname(FILE_DIR)
+PICKLED_LANDMARKS_DIR = "landmarks"  # the directory of the landmarks pickled by extract_faces.py
+
+### NOTE: we assume that all visible files in source dir are images ###
+SOURCE_DIR = os.path.join(FILE_DIR, "processing", "cleaned")
+WORK_DIR = os.path.join(FILE_DIR, "processing")
+DATASET_DIR = os.path.join(FILE_DIR, "instagram")
+
+# The caches of the stages are journals (JSON lines) in `<work dir>/.pipeline`
+CACHE_DIR = ".pipeline"
+
+
+#################### STAGES ####################
+
+
+def split_task(path, splits_dir):
+    """Split an image into before and after images (see split_images.py)."""
+    split_paths = list(split_image(os.path.basename(path), os.path.dirname(path), splits_dir))
+    return split_paths, split_paths
+
+
+def extract_task(path, faces_dir, with_landmarks=True, pyramid_sizes=(), **kwargs):
+    """Extract the face, and its landmarks, from a split image (see extract_faces.py)."""
+
+    landmarks_dir = os.path.join(faces_dir, PICKLED_LANDMARKS_DIR) if with_landmarks else None
+    face_name = extract_face(os.path.basename(path), os.path.dirname(path), faces_dir,
+                             pyramid_sizes, landmarks_dir, **kwargs)
+
+    face_path = os.path.join(faces_dir, face_name)
+    files = [face_path] + [os.path.join(faces_dir, PYRAMID_DIR, str(size), face_name) for size in pyramid_sizes]
+    if landmarks_dir is not None:
+        files += [os.path.join(landmarks_dir, face_name.split(".")[0] + ext) for ext in (".pickle", ".png")]
+
+    return [face_path], files
+
+
+def landmarks_task(path):
+    """
+    Extract the landmarks of a face which has none (e.g. extracted before the landmarks were
+    saved with the faces). The landmarks are owned by the extract stage, which invalidates them.
+    """
+    faces_dir, face_name = os.path.split(path)
+    extract_landmarks(face_name, faces_dir, os.path.join(faces_dir, PICKLED_LANDMARKS_DIR))
+    return [path], []
+
+
+def pack_task(path, dataset_dir, with_landmarks=True):
+    """
+    Lay out a face in a MakeupDataset2 directory (before faces in `nomakeup`, after faces in `makeup`),
+    with its pickled landmarks, by hard-linking them (or copying them across devices).
+    """
+
+    faces_dir, face_name = os.path.split(path)
+    domain = "nomakeup" if face_name.find("before") != -1 else "makeup"
+
+    links = [(path, os.path.join(dataset_dir, domain, face_name))]
+    if with_landmarks:
+        pickle_name = face_name.split(".")[0] + ".pickle"
+        links.append((os.path.join(faces_dir, PICKLED_LANDMARKS_DIR, pickle_name),
+                      os.path.join(dataset_dir, domain, PICKLED_LANDMARKS_DIR, pickle_name)))
+
+    for source, target in links:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target + ".tmp")
+        except OSError:
+            shutil.copy2(source, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+    targets = [target for _, target in links]
+    return targets[:1], targets
+
+
+def run_task(task, path):
+    """
+    Run a task on an input path in a worker, capturing what it prints.
+
+    Returns:
+        The outputs of the task (passed on to the next stage), the files it wrote, its error
+        (None if successful), what it printed, and its running time.
+    """
+
+    start_time = time.perf_counter()
+    output = io.StringIO()
+    outputs, files, error = [], [], None
+    with contextlib.redirect_stdout(output):
+        try:
+            outputs, files = task(path)
+        except Exception as e:
+            error = str(e).strip() or e.__class__.__name__
+    return outputs, files, error, output.getvalue(), time.perf_counter() - start_time
+
+
+#################### PIPELINE ####################
+
+
+class StageCache:
+    """
+    The cache of a stage: an append-only journal (JSON lines) of the last run of the stage on each
+    input path, with the key of the input (content hash and stage config), its outputs, its files,
+    and its error (failures are cached too, so e.g. images without faces aren't retried every run).
+    """
+
+    def __init__(self, path):
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write of a crash
+                    self.records[record["input"]] = record
+
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+
+    def get(self, input_path):
+        return self.records.get(input_path)
+
+
+    def put(self, input_path, key, outputs, files, error=None):
+        record = {"input": input_path, "key": key, "outputs": outputs, "files": files, "error": error}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[input_path] = record
+
+
+    def close(self):
+        self.file.close()
+
+
+class Stage:
+    """A stage of the pipeline, which runs a task on each of its inputs in a pool of worker processes."""
+
+    def __init__(self, name, task, workers=1):
+        """
+        Initializes Stage.
+
+        Args:
+            name: The name of the stage.
+            task: A picklable function of an input path that returns the outputs (paths passed on
+                  to the next stage) and all files written for the input.
+            workers: Number of worker processes of the stage.
+        """
+
+        self.name = name
+        self.task = task
+        self.workers = workers
+
+        # The key of an input depends on the config of the task as well as on the content of the input
+        self.config = repr((task.func.__name__, task.args, sorted(task.keywords.items())))
+
+        self.num_processed = 0
+        self.num_cached = 0
+        self.num_failed = 0
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        self.error = None  # the exception that stopped the stage, if any
+        self.lock = threading.Lock()
+
+
+    def key(self, path):
+        sha1 = hashlib.sha1(self.config.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+
+    def run(self, inputs, outputs, cache, log):
+        """
+        Run the stage on the inputs read from the `inputs` queue (until None), and put their
+        outputs in the `outputs` queue (then None). Inputs whose key didn't change since the last
+        run are not processed again, and at most 2 * workers inputs are processed at once.
+        If the stage fails, its exception is kept in `self.error`, the rest of its inputs are
+        discarded and its outputs are still terminated with None, so the pipeline doesn't hang.
+
+        Args:
+            inputs: The queue of the input paths of the stage.
+            outputs: The queue of the output paths of the stage.
+            cache: The StageCache of the stage.
+            log: A function that writes to the log of the pipeline.
+        """
+
+        start_time = time.time()
+        in_flight = threading.Semaphore(2 * self.workers)
+
+        def done(future, path, key):
+            try:
+                try:
+                    task_outputs, files, error, output, elapsed = future.result()
+                except Exception as e:  # e.g. a worker crashed
+                    task_outputs, files, error, output, elapsed = [], [], str(e), "", 0.0
+
+                with self.lock:
+                    self.num_processed += 1
+                    self.num_failed += error is not None
+                    self.busy_time += elapsed
+
+                log("[{}] {} ... {}\n{}".format(self.name, path, error or "Done.", output), error is not None)
+                cache.put(path, key, task_outputs, files, error)
+                for output_path in task_outputs:
+                    outputs.put(output_path)  # blocks while the next stage is behind
+            except Exception as e:
+                with self.lock:
+                    if self.error is None: self.error = e
+            finally:
+                in_flight.release()
+
+        exhausted = False  # whether the None of the inputs was read
+        try:
+            with ProcessPoolExecutor(self.workers, initializer=init_worker) as executor:
+                while self.error is None:
+                    path = inputs.get()
+                    if path is None:
+                        exhausted = True
+                        break
+
+                    try:
+                        key = self.key(path)
+                    except OSError as e:
+                        log("[{}] {} ... {}\n".format(self.name, path, e), True)
+                        continue
+
+                    # Skip inputs that didn't change (if all their files still exist)
+                    record = cache.get(path)
+                    if record is not None and record["key"] == key and all(map(os.path.exists, record["files"])):
+                        with self.lock: self.num_cached += 1
+                        for output_path in record["outputs"]:
+                            outputs.put(output_path)
+                        continue
+
+                    # Remove the stale files of a changed input
+                    if record is not None:
+                        for stale_path in record["files"]:
+                            if os.path.exists(stale_path): os.remove(stale_path)
+
+                    in_flight.acquire()
+                    future = executor.submit(run_task, self.task, path)
+                    future.add_done_callback(functools.partial(done, path=path, key=key))
+
+        except Exception as e:  # e.g. the pool is broken
+            with self.lock:
+                if self.error is None: self.error = e
+
+        finally:
+            if self.error is not None:
+                log("[{}] Stage failed: {!r}\n".format(self.name, self.error), True)
+
+            # Discard the rest of the inputs, so that the previous stages don't block on a failed stage
+            while not exhausted:
+                exhausted = inputs.get() is None
+
+            self.wall_time = time.time() - start_time
+            outputs.put(None)
+
+
+    def report(self):
+        utilization = self.busy_time / max(self.wall_time * self.workers, 1e-9)
+        return "{:>10} {:>7} {:>9} {:>7} {:>7} {:>10.2f} {:>11.0%}".format(
+            self.name, self.workers, self.num_processed, self.num_cached, self.num_failed,
+            self.num_processed / max(self.wall_time, 1e-9), utilization)
+
+
+def run_pipeline(stages, input_paths, cache_dir, log_path=None):
+    """
+    Stream input paths through a chain of stages. Each stage runs in its own pool of workers,
+    and stages are connected by bounded queues, so a slow stage holds back the previous ones.
+
+    Args:
+        stages: The stages of the pipeline, in order.
+        input_paths: The input paths of the first stage.
+        cache_dir: The directory of the caches of the stages.
+        log_path: Path of the log of the pipeline (the output of all inputs of all stages), if given.
+
+    Returns:
+        The outputs of the last stage.
+
+    Raises:
+        The exception of the first stage that failed, if any.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    caches = [StageCache(os.path.join(cache_dir, stage.name + ".jsonl")) for stage in stages]
+
+    log_file = open(log_path, "a") if log_path else None
+    log_lock = threading.Lock()
+
+    def log(message, is_error=False):
+        with log_lock:
+            if is_error: print(message, end="")
+            if log_file is not None: log_file.write(message)
+
+    # The outputs of the last stage are collected here, so its queue is not bounded
+    queues = [queue.Queue(maxsize=4 * stage.workers) for stage in stages] + [queue.Queue()]
+    threads = [threading.Thread(target=stage.run, args=(queues[i], queues[i + 1], caches[i], log), daemon=True)
+               for i, stage in enumerate(stages)]
+
+    start_time = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for path in input_paths:
+            queues[0].put(path)
+        queues[0].put(None)
+
+        results = list(iter(queues[-1].get, None))
+        for thread in threads:
+            thread.join()
+
+    finally:
+        for cache in caches:
+            cache.close()
+        if log_file is not None:
+            log_file.close()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    # Report throughput of the stages, and the most utilized (bottleneck) stage
+    print("Pipeline finished in {:.1f}s.".format(time.time() - start_time))
+    print("{:>10} {:>7} {:>9} {:>7} {:>7} {:>10} {:>11}".format(
+        "stage", "workers", "processed", "cached", "failed", "items/sec", "utilization"))
+    for stage in stages:
+        print(stage.report())
+    bottleneck = max(stages, key=lambda stage: stage.busy_time / stage.workers)
+    if bottleneck.busy_time > 0:
+        print("Bottleneck: {} (add workers to it).".format(bottleneck.name))
+
+    return results
+
+
+def main(args):
+
+    splits_dir = os.path.join(args.work_dir, "splits")
+    faces_dir = os.path.join(args.work_dir, "faces")
+    for directory in (splits_dir, faces_dir, args.dataset_dir):
+        os.makedirs(directory, exist_ok=True)
+    if args.with_landmarks:
+        os.makedirs(os.path.join(faces_dir, PICKLED_LANDMARKS_DIR), exist_ok=True)
+
+    stages = []
+    if not args.skip_split:
+        stages.append(Stage("split", functools.partial(split_task, splits_dir=splits_dir), args.split_workers))
+    stages.append(Stage("extract", functools.partial(
+        extract_task, faces_dir=faces_dir, with_landmarks=args.with_landmarks, pyramid_sizes=tuple(args.pyramid_sizes),
+        face_size=args.face_size, detect_max_side=args.detect_max_side, refine=args.refine,
+        prescreen_thresholds=prescreen_thresholds_of(args)), args.workers))
+    if args.with_landmarks:
+        stages.append(Stage("landmarks", functools.partial(landmarks_task), args.workers))
+    stages.append(Stage("pack", functools.partial(
+        pack_task, dataset_dir=args.dataset_dir, with_landmarks=args.with_landmarks), 1))
+
+    input_paths = (os.path.join(args.source_dir, f) for f in sorted(files_iter(args.source_dir)))
+    run_pipeline(stages, input_paths, os.path.join(args.work_dir, CACHE_DIR),
+                 os.path.join(args.work_dir, "pipeline.log"))
+
+    # Build the dataset-wide stores (both reuse the work of the previous build where they can)
+    if args.with_landmarks:
+        subprocess.run([sys.executable, os.path.join(DATASET_SCRIPTS_DIR, "landmarks.py"),
+                        "--dataset_dir", args.dataset_dir], check=True)
+    if args.pack_sizes:
+        subprocess.run([sys.executable, os.path.join(DATASET_SCRIPTS_DIR, "packed.py"),
+                        "--dataset_dir", args.dataset_dir, "--image_size"] + [str(s) for s in args.pack_sizes], check=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="run the preprocessing pipeline (split, extract faces, landmarks, pack) incrementally.")
+
+    parser.add_argument('--source_dir', type=str, default=SOURCE_DIR,
+        help="source directory of the (cleaned) images.")
+    parser.add_argument('--work_dir', type=str, default=WORK_DIR,
+        help="directory of the intermediate results (splits, faces), caches and log of the pipeline.")
+    parser.add_argument('--dataset_dir', type=str, default=DATASET_DIR,
+        help="directory of the dataset (MakeupDataset2 layout) where faces are packed.")
+    parser.add_argument("--skip_split", action="store_true",
+        help="the source images are already split into before and after images.")
+    parser.add_argument("--with_landmarks", action="store_true",
+        help="extract faces landmarks as well, and build the landmarks store of the dataset")
+    parser.add_argument("--pyramid_sizes", type=int, nargs="*", default=[],
+        help="also save faces at these resolutions (see pyramid.py)")
+    parser.add_argument("--face_size", type=int, default=None,
+        help="save faces at this (square) training resolution instead of their cropped size")
+    parser.add_argument("--detect_max_side", type=int, default=None,
+        help="detect faces on copies of the images downscaled to this longest side")
+    parser.add_argument("--refine", action="store_true",
+        help="refine the landmarks at full resolution when detecting on downscaled copies")
+    add_prescreen_arguments(parser)
+    parser.add_argument("--pack_sizes", type=int, nargs="*", default=[],
+        help="pack the dataset at these training resolutions (see packed.py)")
+    parser.add_argument("--split_workers", type=int, default=2,
+        help="number of worker processes of the split stage")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+        help="number of worker processes of the extract and landmarks stages")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,75 @@
+import os
+import argparse
+from PIL import Image
+
+from utility import files_iter
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+### NOTE: we assume that all visible files in source dir are images ###
+SOURCE_DIR = os.path.join(FILE_DIR, "processing", "faces")
+
+# The pyramid of an image is saved in `<image dir>/pyramid/<size>/<image name>`
+PYRAMID_DIR = "pyramid"
+PYRAMID_SIZES = (32, 64, 128, 256)
+
+
+def save_pyramid(face_img, file_name, dest_dir, sizes=PYRAMID_SIZES):
+    """
+    Save a face image at a pyramid of (square) resolutions.
+
+    Args:
+        face_img: The face image in PIL format.
+        file_name: The name of the face image.
+        dest_dir: Directory of the face image, where its pyramid will be saved.
+        sizes: The sizes of the levels of the pyramid.
+    """
+
+    for size in sizes:
+        level_dir = os.path.join(dest_dir, PYRAMID_DIR, str(size))
+        os.makedirs(level_dir, exist_ok=True)
+
+        level_path = os.path.join(level_dir, file_name)
+        if not os.path.exists(level_path):
+            level_img = face_img.resize((size, size), Image.BILINEAR)
+            level_img.save(level_path, quality=95)
+
+
+def build_pyramids(source_dir, sizes=PYRAMID_SIZES):
+    """
+    Save the pyramids of all images in source_dir (e.g. faces extracted previously).
+
+    Args:
+        source_dir: Directory of source images.
+        sizes: The sizes of the levels of the pyramids.
+    """
+
+    for file_name in files_iter(source_dir):
+        try:
+            print("Saving pyramid of {}... ".format(file_name), end="")
+            with Image.open(os.path.join(source_dir, file_name)) as img:
+                save_pyramid(img.convert("RGB"), file_name, source_dir, sizes)
+            print("Done.")
+
+        except Exception as e:
+            print("Failed."); print(f"  {str(e)}")
+
+
+def main(args):
+    build_pyramids(args.source_dir, args.sizes)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="save images at a pyramid of resolutions.")
+
+    parser.add_argument('--source_dir', type=str, default=SOURCE_DIR,
+        help="source directory of images (e.g. faces) whose pyramids will be saved.")
+    parser.add_argument('--sizes', type=int, nargs="+", default=PYRAMID_SIZES,
+        help="sizes of the levels of the pyramids.")
+
+    args = parser.parse_args()
+
+    main(args)
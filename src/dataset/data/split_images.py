@@ -1,9 +1,11 @@
 
 import os
 import argparse
+import functools
 from PIL import Image
 
 from utility import files_iter
+from work_queue import WorkQueue, drain
 
 
 # Get absolute path of this file and force relative-to-file paths
@@ -22,6 +24,9 @@ def split_image(file_name, source_dir, dest_dir):
         file_name: The name of the file (image) to be split.
         source_dir: Directory of source images.
         dest_dir: Directory where split images will be saved.
+
+    Returns:
+        The paths of the left (before) and right (after) split images.
     """
 
     with Image.open(os.path.join(source_dir, file_name)) as img:
@@ -33,7 +38,7 @@ def split_image(file_name, source_dir, dest_dir):
         img_path_right = os.path.join(dest_dir, "{}-after.{}".format(img_name, ext))
 
         if os.path.exists(img_path_left) or os.path.exists(img_path_right):
-            return  # this checks if the images was already split
+            return img_path_left, img_path_right  # this checks if the images was already split
 
         # Create left and right crops for splitting the image
         (left, upper, right, lower) = img.getbbox()
@@ -45,19 +50,46 @@ def split_image(file_name, source_dir, dest_dir):
         img.crop(left_box).save(img_path_left, format=img.format)
         img.crop(right_box).save(img_path_right, format=img.format)
 
+    return img_path_left, img_path_right
+
+
+def try_split_image(file_name, source_dir, dest_dir):
+    """
+    Try to split the image `file_name` and save the splits.
+
+    Returns:
+        The error message (None if successful) and the output of the split.
+    """
+    output = "Splitting image {}... ".format(file_name.split(".")[0])
+    try:
+        split_image(file_name, source_dir, dest_dir)
+        return None, output + "Done.\n"
+    except Exception as e:
+        return str(e), output + "Failed.\n"
+
 
-def split_images(source_dir, dest_dir):
+def split_images(source_dir, dest_dir, queue_dir=None, workers=1):
     """
     Try to split the images in source_dir and save them to dest_dir.
 
     Args:
         source_dir: Directory of source images.
         dest_dir: Directory where processed images will be saved.
+        queue_dir: Directory of a work queue shared with other nodes (see `WorkQueue`), if given.
+        workers: Number of worker processes splitting the images claimed from the work queue.
     """
 
     # Create destination directory if it doesn't exist
     if not os.path.isdir(dest_dir): os.mkdir(dest_dir)
 
+    if queue_dir is not None:
+        work_queue = WorkQueue(queue_dir)
+        work_queue.populate(files_iter(source_dir))
+        split = functools.partial(try_split_image, source_dir=source_dir, dest_dir=dest_dir)
+        for error, output in drain(work_queue, split, workers):
+            print(output, end="")
+        return
+
     for file_name in files_iter(source_dir):
         try:
             # We assume that file_name has no dots except the one before its extension
@@ -70,7 +102,7 @@ def split_images(source_dir, dest_dir):
 
 
 def main(args):
-    split_images(args.source_dir, args.dest_dir)
+    split_images(args.source_dir, args.dest_dir, args.queue_dir, args.workers)
 
 
 if __name__ == '__main__':
@@ -81,6 +113,10 @@ if __name__ == '__main__':
         help="source directory of images to be split in half.")
     parser.add_argument('--dest_dir', type=str, default=DEST_DIR,
         help="destination directory where split images will be saved.")
+    parser.add_argument('--queue_dir', type=str, default=None,
+        help="directory of a work queue (on a shared volume) to share the images with other nodes running the same command.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help="number of worker processes splitting the images claimed from the work queue.")
     
     args = parser.parse_args()
 
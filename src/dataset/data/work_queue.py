@@ -0,0 +1,327 @@
+import os
+import time
+import errno
+import random
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+# A work queue is a (shared) directory of empty files, one per item, which are moved
+# between the state directories below with atomic renames. A rename of a given path
+# succeeds on at most one node, so only one node claims (or steals) an item.
+TODO_DIR = "todo"
+LEASED_DIR = "leased"  # leases are named "<expiry>.<node>.<item>", and renewed by renaming them
+DONE_DIR = "done"
+FAILED_DIR = "failed"  # failed items hold their error message
+
+# The files of the items in `todo` and `leased` hold their number of attempts, so that an item
+# that keeps crashing nodes (or their workers) is moved to `failed` instead of bouncing forever
+MAX_ATTEMPTS = 3
+
+LEASE_TIME = 600  # seconds before the lease of an item expires, unless it is renewed
+POLL_TIME = 10  # seconds between checks of the leases of other nodes, when there is nothing left to claim
+
+
+def node_name():
+    """
+    The name of this node (host and process), without dots since they separate the fields of a lease.
+    """
+    return "{}-{}".format(socket.gethostname(), os.getpid()).replace(".", "-")
+
+
+def try_rename(source, dest):
+    """
+    Rename `source` to `dest`, and return False if `source` doesn't exist (e.g. another node renamed it first).
+    """
+    try:
+        os.rename(source, dest)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class WorkQueue:
+    """
+    A work queue shared by several nodes (e.g. on an NFS volume), with no other service than
+    the filesystem. Nodes claim items by moving them from `todo` to `leased`, renew the leases
+    of their items periodically, and move them to `done` (or `failed`) when they are processed.
+    When there is nothing left to claim, nodes steal the expired leases of crashed nodes.
+
+    Usage:
+        work_queue = WorkQueue(queue_dir)
+        work_queue.populate(items)
+        with work_queue:  # renews the leases in the background
+            item = work_queue.claim()
+            ...
+            work_queue.complete(item)
+    """
+
+    def __init__(self, queue_dir, lease_time=LEASE_TIME, max_attempts=MAX_ATTEMPTS):
+        self.queue_dir = queue_dir
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.node = node_name()
+        self.leases = {}  # item -> the path of its lease, for the items of this node
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+
+    def path(self, state, name=""):
+        return os.path.join(self.queue_dir, state, name)
+
+
+    def populate(self, items):
+        """
+        Create the queue with `items`, unless another node created it first. The items are
+        written to a private directory which is then renamed to `todo`, so nodes never see
+        a partial queue. To queue new items, delete the queue directory (when it is drained).
+
+        Returns:
+            Whether this node created the queue.
+        """
+
+        os.makedirs(self.queue_dir, exist_ok=True)
+        for state in (LEASED_DIR, DONE_DIR, FAILED_DIR):
+            os.makedirs(self.path(state), exist_ok=True)
+        if os.path.isdir(self.path(TODO_DIR)):
+            return False
+
+        private_dir = self.path(".{}.{}".format(TODO_DIR, self.node))
+        os.makedirs(private_dir)
+        for item in items:
+            open(os.path.join(private_dir, item), "w").close()
+
+        try:
+            os.rename(private_dir, self.path(TODO_DIR))
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            for item in os.listdir(private_dir):
+                os.remove(os.path.join(private_dir, item))
+            os.rmdir(private_dir)
+            return False
+
+
+    def lease_path(self, item):
+        return self.path(LEASED_DIR, "{}.{}.{}".format(int(time.time() + self.lease_time), self.node, item))
+
+
+    def claim(self):
+        """
+        Claim an item: an item that is left to do, or else an item whose lease expired.
+
+        Returns:
+            The item, or None if there is nothing to claim (for now).
+        """
+
+        # Try the items in random order, so nodes rarely compete for the same item
+        items = os.listdir(self.path(TODO_DIR))
+        random.shuffle(items)
+        for item in items:
+            lease = self.lease_path(item)
+            if try_rename(self.path(TODO_DIR, item), lease) and self.start(item, lease):
+                return item
+
+        # Steal the expired leases of other nodes (e.g. which crashed)
+        now = time.time()
+        leases = os.listdir(self.path(LEASED_DIR))
+        random.shuffle(leases)
+        for old_lease in leases:
+            expiry, node, item = old_lease.split(".", 2)
+            if int(expiry) >= now:
+                continue
+            lease = self.lease_path(item)
+            if try_rename(self.path(LEASED_DIR, old_lease), lease):
+                print("Reclaimed the expired lease of {} from {}.".format(item, node))
+                if self.start(item, lease):
+                    return item
+
+        return None
+
+
+    def start(self, item, lease):
+        """
+        Count an attempt at an item just claimed by this node, and hold its lease, unless
+        the item had too many attempts, in which case it is moved to `failed`.
+
+        Returns:
+            Whether the item can be processed.
+        """
+
+        with open(lease, "r+") as f:
+            attempts = int(f.read() or 0) + 1
+            f.seek(0)
+            f.write(str(attempts))
+            f.truncate()
+
+        if attempts > self.max_attempts:
+            if try_rename(lease, self.path(FAILED_DIR, item)):
+                with open(self.path(FAILED_DIR, item), "w") as f:
+                    f.write("Gave up after {} attempts.".format(self.max_attempts))
+            return False
+
+        with self.lock:
+            self.leases[item] = lease
+        return True
+
+
+    def renew(self):
+        """
+        Renew the leases of the items of this node. Leases stolen by other nodes are dropped.
+        """
+        with self.lock:
+            for item, old_lease in list(self.leases.items()):
+                lease = self.lease_path(item)
+                if try_rename(old_lease, lease):
+                    self.leases[item] = lease
+                else:
+                    print("Lost the lease of {}.".format(item))
+                    del self.leases[item]
+
+
+    def finish(self, item, state):
+        with self.lock:
+            lease = self.leases.pop(item, None)
+        return lease is not None and try_rename(lease, self.path(state, item))
+
+
+    def complete(self, item, error=None):
+        """
+        Move an item of this node to `done`, or to `failed` with its error message.
+        """
+        if self.finish(item, DONE_DIR if error is None else FAILED_DIR) and error is not None:
+            with open(self.path(FAILED_DIR, item), "w") as f:
+                f.write(error)
+
+
+    def release(self, item, attempted=True):
+        """
+        Give up an item of this node, so that it can be claimed again.
+
+        Args:
+            item: The item.
+            attempted: Whether the item was (partly) processed, i.e. whether this counts as an attempt.
+        """
+        if not attempted:
+            with self.lock:
+                lease = self.leases.get(item)
+                if lease is not None and os.path.exists(lease):
+                    with open(lease, "r+") as f:
+                        attempts = int(f.read() or 1) - 1
+                        f.seek(0)
+                        f.write(str(attempts))
+                        f.truncate()
+        self.finish(item, TODO_DIR)
+
+
+    def is_drained(self):
+        """
+        Check whether all the items are processed (by any node).
+        """
+        # Check `todo` again after `leased`, in case an item was released in between
+        return (not os.listdir(self.path(TODO_DIR)) and not os.listdir(self.path(LEASED_DIR))
+                and not os.listdir(self.path(TODO_DIR)))
+
+
+    def claim_once(self, name):
+        """
+        Claim a task that only one node should do (e.g. cleaning up once the queue is drained).
+
+        Returns:
+            Whether this node claimed it.
+        """
+        try:
+            os.mkdir(self.path("once-" + name))
+            return True
+        except FileExistsError:
+            return False
+
+
+    def counts(self):
+        return {state: len(os.listdir(self.path(state))) for state in (TODO_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR)}
+
+
+    def __enter__(self):
+        def renew_leases():
+            while not self.stopped.wait(self.lease_time / 4):
+                self.renew()
+
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=renew_leases, daemon=True)
+        self.heartbeat.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.heartbeat.join()
+
+        # Give back the items of this node that are not processed (e.g. on interrupt)
+        for item in list(self.leases):
+            self.release(item)
+
+
+def drain(work_queue, function, workers=1, initializer=None):
+    """
+    A generator that claims the items of a work queue and processes them with `function`
+    in `workers` processes, until the queue is drained by all the nodes. The items of
+    this node are processed (and leased) at most `workers` at a time, so that the other
+    nodes can claim the rest. If processing stops (e.g. on interrupt, or if a worker crashes),
+    the items that didn't start are given back, and the items that are running are finished
+    (or given back if they failed) only once their workers are done with them.
+
+    Args:
+        work_queue: The WorkQueue.
+        function: The function processing an item, which returns its error message (None
+                  if successful) and its output, like `extract_faces.try_extract_face`.
+        workers: Number of worker processes (the items are processed in this process if 1).
+        initializer: The initializer of the worker processes.
+
+    Yields:
+        The result of `function` for each item processed by this node.
+    """
+
+    executor = ProcessPoolExecutor(workers, initializer=initializer) if workers > 1 else None
+    futures = {}  # future -> item
+    with work_queue:
+        try:
+            while True:
+                while len(futures) < workers:
+                    item = work_queue.claim()
+                    if item is None:
+                        break
+                    if executor is None:
+                        result = function(item)
+                        work_queue.complete(item, result[0])
+                        yield result
+                    else:
+                        futures[executor.submit(function, item)] = item
+
+                if futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        work_queue.complete(futures.pop(future), result[0])
+                        yield result
+                elif work_queue.is_drained():
+                    break
+                else:
+                    # Other nodes are processing the rest, wait in case their leases expire
+                    time.sleep(POLL_TIME)
+        finally:
+            if executor is not None:
+                for future, item in list(futures.items()):
+                    if future.cancel():
+                        work_queue.release(item, attempted=False)
+                        del futures[future]
+
+                # Wait for the running items, so no other node claims an item that a worker is still writing
+                executor.shutdown(wait=True)
+                for future, item in futures.items():
+                    try:
+                        work_queue.complete(item, future.result()[0])
+                    except Exception:  # e.g. the worker crashed on this item (or another one)
+                        work_queue.release(item)
@@ -1,12 +1,18 @@
 
 import os
+import numpy as np
 import torch
 import torch.utils.data as data_utils
 
-import random
 import glob
 from PIL import Image
 
+from .packed import PackedImages
+from .landmarks import LandmarksStore, LANDMARKS_INDEX
+from .samplers import UnpairedSampler, PairedSampler
+from .cache import SharedImageCache
+from .manifest import Manifest
+
 try:
     from face_recognition import face_landmarks
 except ImportError:
@@ -15,6 +21,10 @@ except ImportError:
         raise NotImplementedError("face_recognition module is not available.")
 
 
+# The pyramid of an image is stored in `<image dir>/pyramid/<size>/<image name>` (see data/pyramid.py)
+PYRAMID_DIR = "pyramid"
+
+
 def dict_to_list(d):
     return [x for l in d.values() for x in l]
 
@@ -30,7 +40,13 @@ class MakeupDataset(data_utils.Dataset):
                  transform=None,
                  with_landmarks=False,
                  paired=False,
-                 reverse=False):
+                 reverse=False,
+                 image_size=None,
+                 cache_bytes=0,
+                 use_manifest=False,
+                 filters={},
+                 pyramid=False,
+                 fast_decode=False):
         """
         Initializes MakeupDataset.
 
@@ -40,8 +56,28 @@ class MakeupDataset(data_utils.Dataset):
             with_landmarks: A flag indicating whether landmarks should be used or not.
             paired: Indicates whether images should be paired when sampled or not.
             reverse: Reverses sample if True (before = with makeup, after = no makeup).
+            image_size: Resize images to (image_size x image_size) when loaded, if given.
+            cache_bytes: Budget in bytes of the cache of decoded and resized images, which is shared
+                         by all workers of the data loader (requires `image_size`, 0 to disable).
+            use_manifest: List the images from the dataset's manifest (see manifest.py) instead
+                          of listing the directory, refreshing the manifest if needed.
+            filters: Use only the images whose manifest entries match these filters (see `manifest.matches`),
+                     e.g. {"has_landmarks": True, "min_side": 128}.
+            pyramid: Decode images from the smallest level of their pyramids (see data/pyramid.py)
+                     at or above `image_size`, if they were stored.
+            fast_decode: Decode JPEGs at the smallest power-of-two scale (1/2, 1/4, 1/8) whose size
+                         is still at or above `image_size`, before resizing them to `image_size`.
         """
 
+        if cache_bytes > 0 and image_size is None:
+            raise ValueError("Caching decoded images requires an image_size.")
+        if pyramid and image_size is None:
+            raise ValueError("Decoding from pyramids requires an image_size.")
+        if fast_decode and image_size is None:
+            raise ValueError("Fast decoding requires an image_size.")
+        if filters and not use_manifest:
+            raise ValueError("Filtering images requires the manifest.")
+
         if not os.path.isdir(dataset_dir):
             raise FileNotFoundError(f"Dataset directory '{dataset_dir}' does not exist.")
 
@@ -50,11 +86,28 @@ class MakeupDataset(data_utils.Dataset):
         self.transform = transform
         self.paired = paired
         self.reverse = reverse
+        self.image_size = image_size
+        self.filters = filters
+        self.fast_decode = fast_decode
 
+        self.manifest = Manifest(dataset_dir) if use_manifest else None
         self.images_before, self.images_after = self.get_images()
+        self.pyramid_levels = self.get_pyramid_levels() if pyramid else {}
         self.landmarks_cache = {}
         self.landmarks_size = [72, 2]
 
+        # Use precomputed landmarks (see landmarks.py) if they exist
+        self.landmarks_store = None
+        if with_landmarks and os.path.isfile(os.path.join(dataset_dir, LANDMARKS_INDEX)):
+            self.landmarks_store = LandmarksStore(dataset_dir)
+
+        # Cache decoded and resized images in shared memory, keyed by their index in this dataset
+        self.image_cache = None
+        if cache_bytes > 0:
+            all_images = self.images_before + self.images_after
+            self.cache_keys = {path: key for key, path in enumerate(all_images)}
+            self.image_cache = SharedImageCache(len(all_images), image_size, cache_bytes)
+
 
     def get_images(self):
         """
@@ -64,6 +117,9 @@ class MakeupDataset(data_utils.Dataset):
             A list of tuples of the names of before and after makeup images in `dataset_dir`.
         """
 
+        if self.manifest is not None:
+            return self.manifest.paths("before", self.filters), self.manifest.paths("after", self.filters)
+
         all_images = list(files_iter(self.dataset_dir))
         before_images = list(filter(lambda s: s.find("before") != -1, all_images))
         after_images = list(filter(lambda s: s.find("after") != -1, all_images))
@@ -71,6 +127,28 @@ class MakeupDataset(data_utils.Dataset):
         return sorted(before_images), sorted(after_images)
 
 
+    def get_pyramid_levels(self):
+        """
+        Find the smallest pyramid level at or above `image_size` in each directory of images.
+
+        Returns:
+            A dict of the directories of images which have such a level, and their levels.
+        """
+
+        pyramid_levels = {}
+        for image_dir in set(map(os.path.dirname, self.images_before + self.images_after)):
+            pyramid_dir = os.path.join(image_dir, PYRAMID_DIR)
+            if not os.path.isdir(pyramid_dir):
+                continue
+
+            levels = [int(level) for level in os.listdir(pyramid_dir) if level.isdigit()]
+            levels = [level for level in levels if level >= self.image_size]
+            if len(levels) > 0:
+                pyramid_levels[image_dir] = min(levels)
+
+        return pyramid_levels
+
+
     def __len__(self):
         """Returns the length of the dataset."""
         return min(len(self.images_before), len(self.images_after))
@@ -81,19 +159,19 @@ class MakeupDataset(data_utils.Dataset):
         Get the next data point from the dataset.
 
         Args:
-            index: the index of the data point.
+            index: the index of the data point, or a pair of (before, after) indices
+                   (as sampled by the sampler from `get_sampler`).
 
         Returns:
             The data point transformed and ready for consumption.
         """
 
-        # Shuffle the other list/dataset every time we reiterate from the beginning
-        if not self.paired and index == 0:
-            random.shuffle(self.images_after)
+        # Unpaired images are paired by the sampler (see `get_sampler`)
+        index_before, index_after = index if isinstance(index, tuple) else (index, index)
 
         # Sample before and after images
-        image_before = self.images_before[index]
-        image_after = self.images_after[index]
+        image_before = self.images_before[index_before]
+        image_after = self.images_after[index_after]
 
         # Get path of before and after images
         path_before = image_before #os.path.join(self.dataset_dir, image_before)
@@ -101,8 +179,8 @@ class MakeupDataset(data_utils.Dataset):
 
         # Create sample
         sample = {
-            "before": Image.open(path_before).convert("RGB"),
-            "after":  Image.open(path_after).convert("RGB"),
+            "before": self.load_image(path_before),
+            "after":  self.load_image(path_after),
         }
 
         # Apply transformations on images
@@ -123,10 +201,103 @@ class MakeupDataset(data_utils.Dataset):
         return sample
 
 
+    def get_sampler(self, shuffle=True, cover_larger=True, seed=0):
+        """
+        Get the sampler of (before, after) index pairs of this dataset, which should
+        be used in place of shuffling the dataset in the data loader.
+        Unpaired images are paired randomly every epoch (see `UnpairedSampler.set_epoch`).
+
+        Args:
+            shuffle: Shuffle the images every epoch.
+            cover_larger: Sample all images of the larger domain every epoch (unpaired only).
+            seed: Seed of the per-epoch permutations.
+
+        Returns:
+            The sampler.
+        """
+
+        if self.paired:
+            return PairedSampler(len(self), shuffle=shuffle, seed=seed)
+
+        return UnpairedSampler(len(self.images_before), len(self.images_after),
+                               cover_larger=cover_larger, shuffle=shuffle, seed=seed)
+
+
+    def load_image(self, path):
+        """
+        Load the image in `path` from the cache of decoded images, or decode it and cache it.
+
+        Args:
+            path: The path of the image.
+
+        Returns:
+            The image in PIL format.
+        """
+
+        if self.image_cache is None:
+            return self.decode_image(path)
+
+        key = self.cache_keys[path]
+        cached_image = self.image_cache.get(key)
+        if cached_image is not None:
+            return Image.fromarray(cached_image)
+
+        image = self.decode_image(path)
+        self.image_cache.put(key, np.asarray(image))
+
+        return image
+
+
+    def pyramid_path(self, path):
+        """
+        Get the path of the smallest stored pyramid level of an image at or above `image_size`.
+
+        Args:
+            path: The path of the image.
+
+        Returns:
+            The path of the pyramid level, or `path` if it wasn't stored.
+        """
+
+        image_dir, file_name = os.path.split(path)
+        if image_dir not in self.pyramid_levels:
+            return path
+
+        level = str(self.pyramid_levels[image_dir])
+        level_path = os.path.join(image_dir, PYRAMID_DIR, level, file_name)
+
+        return level_path if os.path.isfile(level_path) else path
+
+
+    def decode_image(self, path):
+        """
+        Decode the image in `path` (from its pyramid if possible), resized to `image_size` if given.
+
+        Args:
+            path: The path of the image.
+
+        Returns:
+            The image in PIL format.
+        """
+
+        image = Image.open(self.pyramid_path(path))
+
+        # Let the JPEG decoder downscale the image (no-op for other formats)
+        if self.fast_decode:
+            image.draft("RGB", (self.image_size, self.image_size))
+
+        image = image.convert("RGB")
+        if self.image_size is not None:
+            image = image.resize((self.image_size, self.image_size), Image.BILINEAR)
+
+        return image
+
+
     def get_landmarks(self, label, image):
         """
         Get the landmarks associated with the label and image.
-        If label is not in landmarks' cache, find the landmarks in image.
+        If label is in the landmarks store, scale the stored landmarks to the image.
+        Otherwise, if label is not in landmarks' cache, find the landmarks in image.
 
         Args:
             label: The label of the image.
@@ -136,7 +307,10 @@ class MakeupDataset(data_utils.Dataset):
             Landmarks in PyTorch tensor format.
         """
 
-        if label in self.landmarks_cache:
+        if self.landmarks_store is not None and label in self.landmarks_store:
+            height, width = image.shape[-2:]
+            landmarks = torch.from_numpy(self.landmarks_store.scaled(label, width, height))
+        elif label in self.landmarks_cache:
             landmarks = self.landmarks_cache[label]
         else:
             landmarks = self.find_landmarks(image)
@@ -207,10 +381,46 @@ class MakeupDataset2(MakeupDataset):
     def __init__(self, dataset_dir,
                  transform=None,
                  with_landmarks=False,
-                 reverse=False):
+                 reverse=False,
+                 image_size=None,
+                 packed=False,
+                 cache_bytes=0,
+                 use_manifest=False,
+                 filters={},
+                 pyramid=False,
+                 fast_decode=False):
+        """
+        Initializes MakeupDataset2.
+
+        Args:
+            dataset_dir: The directory of the dataset.
+            transform: The transform used on the data.
+            with_landmarks: A flag indicating whether landmarks should be used or not.
+            reverse: Reverses sample if True (before = with makeup, after = no makeup).
+            image_size: Resize images to (image_size x image_size) when loaded, if given.
+            packed: Read the images packed at `image_size` by `packed.py` instead of decoding them.
+            cache_bytes: Budget in bytes of the cache of decoded images shared by all workers (0 to disable).
+            use_manifest: List the images from the dataset's manifest instead of listing the directories.
+            filters: Use only the images whose manifest entries match these filters.
+            pyramid: Decode images from the smallest level of their pyramids at or above `image_size`.
+            fast_decode: Decode JPEGs at a reduced scale, still at or above `image_size`.
+        """
+
+        if packed and image_size is None:
+            raise ValueError("Packed images require an image_size.")
+
         # Initialize as an unpaired MakeupDataset
         super().__init__(dataset_dir, transform=transform,
-            with_landmarks=with_landmarks, paired=False, reverse=reverse)
+            with_landmarks=with_landmarks, paired=False, reverse=reverse, image_size=image_size,
+            cache_bytes=0 if packed else cache_bytes, use_manifest=use_manifest, filters=filters,
+            pyramid=pyramid, fast_decode=fast_decode)
+
+        # Memory-mapped, pre-decoded images (sampling them costs no decoding)
+        self.packed_images = []
+        if packed:
+            self.packed_images = [PackedImages(dataset_dir, domain, image_size)
+                                  for domain in ("nomakeup", "makeup")]
+
 
     def get_images(self):
         """
@@ -219,6 +429,9 @@ class MakeupDataset2(MakeupDataset):
         Returns:
             A list of tuples of the names of before and after makeup images in `dataset_dir`.
         """
+        if self.manifest is not None:
+            return self.manifest.paths("nomakeup", self.filters), self.manifest.paths("makeup", self.filters)
+
         nomakeup_dir = os.path.join(self.dataset_dir, "nomakeup")
         makeup_dir = os.path.join(self.dataset_dir, "makeup")
 
@@ -233,3 +446,19 @@ class MakeupDataset2(MakeupDataset):
         return sorted(before_images), sorted(after_images)
 
 
+    def load_image(self, path):
+        """
+        Load the image in `path`, from the packed images if it was packed.
+
+        Args:
+            path: The path of the image.
+
+        Returns:
+            The image in PIL format.
+        """
+
+        for packed_images in self.packed_images:
+            if path in packed_images:
+                return packed_images[path]
+
+        return super().load_image(path)
@@ -0,0 +1,311 @@
+import os
+import json
+import shutil
+import argparse
+import urllib.parse
+import numpy as np
+from PIL import Image
+
+from download_images import DownloadJournal, JOURNAL, PARTIAL_EXT
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DOWNLOAD_DIR = os.path.join(FILE_DIR, "data", "downloaded")
+
+# CDNs that serve the same image from many edge servers, in many sizes and crops, and with
+# signed query strings. The file name of their urls identifies the image.
+CDN_HOSTS = {
+    "fbcdn.net": "instagram",
+    "cdninstagram.com": "instagram",
+    "pinimg.com": "pinterest",
+}
+
+# Query parameters of other hosts that only resize (or recompress) the image
+RESIZE_PARAMS = {"w", "h", "width", "height", "resize", "fit", "crop", "quality", "q", "strip", "ssl"}
+
+# The perceptual hashes of a directory are kept in a hidden file, so `files_iter` skips it
+HASHES_INDEX = ".dhashes.json"
+DUPLICATES_DIR = "duplicates"
+MAX_DISTANCE = 4  # max Hamming distance of the dHashes of near-duplicates
+
+
+#################### URLS ####################
+
+
+def canonical_url(url):
+    """
+    Get the canonical form of an image url, which is the same for the urls of the same image
+    (e.g. in different sizes, from different CDN edge servers, or with different query strings).
+    It is a key for deduplication only; the original url must still be used for downloading.
+
+    Args:
+        url: The url of the image.
+
+    Returns:
+        The canonical url.
+    """
+
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower().rsplit("@", 1)[-1].split(":")[0]
+    if host.startswith("www."):
+        host = host[4:]
+
+    for cdn_host, name in CDN_HOSTS.items():
+        if host == cdn_host or host.endswith("." + cdn_host):
+            return "{}/{}".format(name, parts.path.rstrip("/").rsplit("/", 1)[-1])
+
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k.lower() not in RESIZE_PARAMS)
+    query = urllib.parse.urlencode(query)
+    return host + parts.path.rstrip("/") + ("?" + query if query else "")
+
+
+def dedup_urls(url_files):
+    """
+    A generator that yields the urls of `url_files` (one url per line), without the urls
+    whose canonical url was already seen (i.e. keeping the first url of each image).
+
+    Args:
+        url_files: The paths of the files of urls.
+    """
+
+    seen = set()
+    for url_file in url_files:
+        with open(url_file, "r") as f:
+            for line in f:
+                url = line.strip()
+                if not url:
+                    continue
+                key = canonical_url(url)
+                if key not in seen:
+                    seen.add(key)
+                    yield url
+
+
+#################### IMAGES ####################
+
+
+def dhash(image, hash_size=8):
+    """
+    Compute the difference hash of an image, i.e. whether each pixel of a (hash_size + 1) x hash_size
+    grayscale thumbnail of the image is brighter than its right neighbor.
+
+    Args:
+        image: The image in PIL format.
+        hash_size: The size of the hash (the hash has hash_size^2 bits).
+
+    Returns:
+        The hash as an int.
+    """
+
+    image.draft("L", (4 * hash_size, 4 * hash_size))  # decode JPEGs at a reduced scale
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    A BK-tree of hashes under the Hamming distance, to find the hashes near a hash
+    without comparing it with all of them.
+    """
+
+    def __init__(self):
+        self.root = None  # a node is [hash, item, {distance: child node}]
+
+
+    def add(self, hash, item):
+        node = [hash, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+
+        parent = self.root
+        while True:
+            distance = hamming_distance(hash, parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+
+    def find(self, hash, max_distance):
+        """
+        Find the items whose hash is within `max_distance` of `hash`.
+
+        Returns:
+            A list of (distance, item) pairs.
+        """
+
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_hash, item, children = nodes.pop()
+            distance = hamming_distance(hash, node_hash)
+            if distance <= max_distance:
+                found.append((distance, item))
+
+            # By the triangle inequality, only children at these distances can be near `hash`
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+
+        return found
+
+
+def hash_images(image_dir):
+    """
+    Compute the dHash and the size of the images of `image_dir`, reusing the hashes (saved in the
+    directory) of the images that didn't change since the last call.
+
+    Args:
+        image_dir: The directory of the images.
+
+    Returns:
+        A dict of file name -> {"mtime", "hash", "area"} of the images.
+    """
+
+    index_path = os.path.join(image_dir, HASHES_INDEX)
+    old_hashes = {}
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            old_hashes = json.load(f)
+
+    hashes = {}
+    for entry in os.scandir(image_dir):
+        if entry.name[0] == "." or not entry.is_file():
+            continue
+        if entry.name == JOURNAL or entry.name.endswith(PARTIAL_EXT):
+            continue  # the download journal and partial downloads
+
+        mtime = entry.stat().st_mtime
+        old = old_hashes.get(entry.name)
+        if old is not None and old["mtime"] == mtime:
+            hashes[entry.name] = old
+            continue
+
+        try:
+            with Image.open(entry.path) as image:
+                area = image.width * image.height
+                hashes[entry.name] = {"mtime": mtime, "hash": dhash(image), "area": area}
+        except Exception as e:
+            print("Skipping {}: {}".format(entry.name, e))
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(hashes, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    return hashes
+
+
+def find_duplicates(image_dir, max_distance=MAX_DISTANCE):
+    """
+    Find the near-duplicate images of `image_dir`, i.e. images whose dHashes are within
+    `max_distance` of each other. The largest image of each group of duplicates is kept.
+
+    Args:
+        image_dir: The directory of the images.
+        max_distance: The max Hamming distance of the hashes of near-duplicates.
+
+    Returns:
+        A dict of the file name of each duplicate -> the file name of the image it duplicates.
+    """
+
+    hashes = hash_images(image_dir)
+
+    # Visit larger images first, so that the largest image of duplicates is the one kept
+    file_names = sorted(hashes, key=lambda name: (-hashes[name]["area"], name))
+
+    tree = BKTree()
+    duplicates = {}
+    for file_name in file_names:
+        found = tree.find(hashes[file_name]["hash"], max_distance)
+        if found:
+            duplicates[file_name] = min(found)[1]
+        else:
+            tree.add(hashes[file_name]["hash"], file_name)
+
+    return duplicates
+
+
+def remove_duplicates(image_dir, max_distance=MAX_DISTANCE, delete=False):
+    """
+    Move the near-duplicate images of `image_dir` to its `duplicates` directory
+    (so they can be reviewed), or delete them. If `image_dir` is a download directory, the
+    duplicates are recorded in its download journal, so that they aren't downloaded again.
+
+    Args:
+        image_dir: The directory of the images.
+        max_distance: The max Hamming distance of the hashes of near-duplicates.
+        delete: Delete the duplicates instead of moving them.
+
+    Returns:
+        The number of duplicates removed.
+    """
+
+    duplicates = find_duplicates(image_dir, max_distance)
+
+    duplicates_dir = os.path.join(image_dir, DUPLICATES_DIR)
+    if duplicates and not delete and not os.path.isdir(duplicates_dir):
+        os.mkdir(duplicates_dir)
+
+    journal = None
+    if duplicates and os.path.isfile(os.path.join(image_dir, JOURNAL)):
+        journal = DownloadJournal(image_dir)
+
+    for file_name, original in sorted(duplicates.items()):
+        print("Removing {} (duplicate of {})".format(file_name, original))
+        image_path = os.path.join(image_dir, file_name)
+        if delete:
+            os.remove(image_path)
+        else:
+            shutil.move(image_path, os.path.join(duplicates_dir, file_name))
+
+        record = journal.get(int(file_name)) if journal is not None and file_name.isdigit() else None
+        if record is not None:
+            journal.record(record["index"], record["url"], "duplicate", error="duplicate of {}".format(original))
+
+    if journal is not None:
+        journal.close()
+
+    print("Removed {} duplicates.".format(len(duplicates)))
+    return len(duplicates)
+
+
+def main(args):
+
+    if args.urls:
+        num_urls = 0
+        with open(args.output, "w") as f:
+            for url in dedup_urls(args.urls):
+                f.write(url + "\n")
+                num_urls += 1
+        print("Wrote {} unique urls to {}.".format(num_urls, args.output))
+
+    if args.image_dir:
+        remove_duplicates(args.image_dir, args.max_distance, args.delete)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Deduplicate image urls before download, and images after download.")
+
+    parser.add_argument("-i", "--urls", type=str, nargs="+", default=[],
+        help="files of urls to be merged and deduplicated by their canonical url.")
+    parser.add_argument("-o", "--output", type=str, default="image_urls.csv",
+        help="the output file of the deduplicated urls.")
+    parser.add_argument("--image_dir", type=str, default=None,
+        help="directory of (downloaded) images to be deduplicated by their perceptual hash.")
+    parser.add_argument("--max_distance", type=int, default=MAX_DISTANCE,
+        help="max Hamming distance of the (64-bit) dHashes of near-duplicate images.")
+    parser.add_argument("--delete", action="store_true",
+        help="delete duplicate images instead of moving them to the 'duplicates' directory.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,8 +1,15 @@
 
+import io
 import time
+import json
+import random
+import hashlib
+import threading
 import requests
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image
 
 # The file where image_urls were exported to
 DOWNLOAD_DIR = os.path.join("data", "downloaded")
@@ -15,101 +22,352 @@ IMAGE_URLS = os.path.join(FILE_DIR, IMAGE_URLS)
 
 # Variables to deal with errors occuring during download
 TRY_AGAIN = False  # retry previously failed requests (for a second run of download.py)
-ERROR_TAG = b"(error)"  # The error tag is always prepended to an error file
-IS_ERROR_FILE = lambda f: f.read()[:len(ERROR_TAG)] == ERROR_TAG
+ERROR_TAG = b"(error)"  # Error files of old downloads (before the journal) start with the error tag
+IS_ERROR_FILE = lambda f: f.read(len(ERROR_TAG)) == ERROR_TAG
 IMAGE_NAME_FORMAT = lambda index: "{:05d}".format(index)  # The format of image names
+PARTIAL_EXT = ".part"  # Images are downloaded to `<image name>.part` and renamed when complete
 
+# The journal of the downloads, in the download directory
+JOURNAL = "journal.jsonl"
 
-def download_image(image_url, image_path="untitled"):
+# Variables of concurrent downloads
+NUM_WORKERS = 16  # number of concurrent downloads
+NUM_RETRIES = 3  # number of retries of a failed request (connection errors, 429 and 5xx only)
+BACKOFF = 0.5  # the n-th retry waits BACKOFF * 2^n seconds (plus jitter)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 1 << 16
+
+# Default normalization of downloaded images (see `normalize_image`)
+MAX_SIDE = 1600  # longest side of normalized images
+QUALITY = 95  # JPEG quality of normalized images
+
+# Each worker thread keeps its own session, i.e. its own pool of connections per host
+thread_local = threading.local()
+
+
+class DownloadJournal:
+    """
+    An append-only journal (JSON lines) of the downloads of a download directory, which records
+    the url, status ("success", "error", or "duplicate" for images removed by dedup.py), size, content hash (sha1) and error of each image index.
+    The last record of an index wins. Records are flushed as soon as a download finishes, so a
+    crash loses only the downloads in flight (a torn last line is ignored when loading).
+    """
+
+    def __init__(self, download_dir):
+        """
+        Initializes DownloadJournal by loading the records of the journal of `download_dir`, if any.
+
+        Args:
+            download_dir: The directory where the images are downloaded.
+        """
+
+        self.path = os.path.join(download_dir, JOURNAL)
+        self.records = {}  # index -> last record
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write of a crash
+                    self.records[record["index"]] = record
+
+        self.file = open(self.path, "a")
+
+
+    def record(self, index, url, status, num_bytes=0, sha1=None, error=None):
+        """
+        Append the record of a finished download to the journal.
+
+        Args:
+            index: The index of the image.
+            url: The url of the image.
+            status: "success", "error" or "duplicate".
+            num_bytes: The size of the image in bytes.
+            sha1: The sha1 hex digest of the image.
+            error: The error message of a failed download.
+        """
+
+        record = {
+            "index": index,
+            "url": url,
+            "status": status,
+            "bytes": num_bytes,
+            "sha1": sha1,
+            "error": error,
+        }
+
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[index] = record
+
+
+    def get(self, index, url=None):
+        """
+        Get the last record of `index`, or None if it has none (or if it was of another url).
+        """
+        record = self.records.get(index)
+        if record is None or (url is not None and record["url"] != url):
+            return None
+        return record
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_session():
+    """
+    Get the requests session of the current thread, whose connections are reused between requests.
     """
-    Download an image from `image_url` and save it to `image_path`.
+    if not hasattr(thread_local, "session"):
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def is_retryable(error):
+    """
+    Check whether a failed request is worth retrying (i.e. the error may be transient).
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def normalize_image(image_path, max_side=MAX_SIDE, quality=QUALITY):
+    """
+    Validate a downloaded image (e.g. it is not an html error page), and re-encode it in place
+    as an RGB JPEG of the given quality, downscaled to `max_side` if larger.
+
+    Args:
+        image_path: The path of the image.
+        max_side: The max length of the longest side of the image (None for no limit).
+        quality: The JPEG quality of the image.
+
+    Returns:
+        The size and the sha1 hex digest of the normalized image.
+
+    Raises:
+        An exception if the file is not a valid image.
+    """
+
+    with Image.open(image_path) as image:
+        if max_side:
+            image.draft("RGB", (max_side, max_side))  # decode large JPEGs at a reduced scale
+        image = image.convert("RGB")  # decodes the whole image, so truncated images fail here
+
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    data = buffer.getvalue()
+
+    with open(image_path, "wb") as f:
+        f.write(data)
+
+    return len(data), hashlib.sha1(data).hexdigest()
+
+
+def download_image(image_url, image_path="untitled", retries=0, backoff=BACKOFF, normalize=None):
+    """
+    Download an image from `image_url` and save it to `image_path`. The image is written to
+    `image_path + PARTIAL_EXT` first, and renamed to `image_path` only when it is complete.
 
     Args:
         image_url: The url of the image to be downloaded.
         image_path: The path where the image will be saved.
+        retries: Number of retries if the request fails with a transient error.
+        backoff: The base of the exponential backoff between retries, in seconds.
+        normalize: Normalize the image with these arguments of `normalize_image` (e.g.
+                   {"max_side": 1600, "quality": 95}) before saving it, if given.
 
     Returns:
-        "Success" or the exception in case of an error.
+        The size and the sha1 hex digest of the image.
+
+    Raises:
+        The exception of the last attempt, if the download failed.
     """
 
+    partial_path = image_path + PARTIAL_EXT
     try:
-        # Download image in chunks
-        with requests.get(image_url, stream=True, timeout=30) as image_response:
-            image_response.raise_for_status()
-            with open(image_path, 'wb') as f:
-                chunk_size = 1 << 10
-                for chunk in image_response.iter_content(chunk_size):
-                    f.write(chunk)
-            return "Success"
-    except Exception as e:
-        # Image will be text describing the error message
-        with open(image_path, 'w') as f:
-            f.write("(error) {}".format(e))
-        return e
-
-
-def download_images(image_urls, download_dir):
+        for attempt in range(retries + 1):
+            try:
+                # Download image in chunks, reusing the connections of this thread's session
+                with get_session().get(image_url, stream=True, timeout=30) as image_response:
+                    image_response.raise_for_status()
+                    num_bytes = 0
+                    sha1 = hashlib.sha1()
+                    with open(partial_path, 'wb') as f:
+                        for chunk in image_response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            sha1.update(chunk)
+                            num_bytes += len(chunk)
+                digest = sha1.hexdigest()
+                if normalize is not None:
+                    num_bytes, digest = normalize_image(partial_path, **normalize)
+                os.replace(partial_path, image_path)
+                return num_bytes, digest
+            except Exception as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+                time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def pending_downloads(image_urls, download_dir, journal, is_dead=None):
     """
-    Download the images from `image_urls` and save them in `download_dir`.
+    A generator that yields the (index, url, path) of the images that still have to be downloaded.
 
     Args:
         image_urls: The urls of the images to be downloaded.
         download_dir: The directory where the images will be saved.
+        journal: The DownloadJournal of `download_dir`.
+        is_dead: A function that tells whether a url is known to be dead (e.g. `ProbeCache.is_dead`),
+                 whose images are skipped, if given.
     """
 
-    # Download images
     for index, image_url in enumerate(image_urls):
 
+        if is_dead is not None and is_dead(image_url):
+            continue
+
         # Create image name and path
         image_name = IMAGE_NAME_FORMAT(index)
         image_path = os.path.join(download_dir, image_name)
 
-        # If a file called 'image_name' already exists, open it and find whether
-        # it has an '(error)' tag in it. If it doesn't, then we already downloaded
-        # it successfully, so we skip it. If it does, then we skip it only if we
-        # don't want to try downloading it again.
-        if os.path.exists(image_path):
+        # Skip images that were downloaded successfully, and failed images
+        # unless we want to try downloading them again
+        record = journal.get(index, image_url)
+        if record is not None:
+            if record["status"] == "success" and os.path.exists(image_path):
+                continue  # skip because we already downloaded this image
+            if record["status"] == "error" and not TRY_AGAIN:
+                continue  # skip because we don't want to try again
+            if record["status"] == "duplicate":
+                continue  # skip because the image was removed as a duplicate
+
+        # Images downloaded before the journal existed are complete unless they are error files
+        elif os.path.exists(image_path):
             with open(image_path, "rb") as image:
                 if not IS_ERROR_FILE(image):
-                    continue  # skip because we already downloaded this image
+                    continue
                 if not TRY_AGAIN:
-                    continue  # skip because we don't want to try again
+                    continue
 
-        # Download image and check download success
-        print("[{:05d}]  Downloading {} ... ".format(index, image_url), end="")
-        status = download_image(image_url, image_path)
-        print(status)
+        yield index, image_url, image_path
+
+
+def download_images(image_urls, download_dir, num_workers=NUM_WORKERS, retries=NUM_RETRIES, backoff=BACKOFF,
+                    normalize=None, is_dead=None):
+    """
+    Download the images from `image_urls` and save them in `download_dir`,
+    with at most `num_workers` concurrent downloads. The result of each download
+    is recorded in the journal of `download_dir`.
+
+    Args:
+        image_urls: The urls of the images to be downloaded.
+        download_dir: The directory where the images will be saved.
+        num_workers: Number of concurrent downloads.
+        retries: Number of retries of a request that fails with a transient error.
+        backoff: The base of the exponential backoff between retries, in seconds.
+        normalize: Normalize the images with these arguments of `normalize_image` in the
+                   download workers, if given.
+        is_dead: A function that tells whether a url is known to be dead, whose images are skipped, if given.
+
+    Returns:
+        The number of images downloaded successfully and the number of failed downloads.
+    """
+
+    def download(journal, index, image_url, image_path):
+        try:
+            num_bytes, sha1 = download_image(image_url, image_path, retries, backoff, normalize)
+            journal.record(index, image_url, "success", num_bytes, sha1)
+            print("[{:05d}]  Downloading {} ... Success".format(index, image_url))
+            return True, num_bytes
+        except Exception as e:
+            journal.record(index, image_url, "error", error=str(e))
+            print("[{:05d}]  Downloading {} ... {}".format(index, image_url, e))
+            return False, 0
+
+    start_time = time.time()
+    num_success, num_failed, total_bytes = 0, 0, 0
+
+    def report():
+        elapsed = time.time() - start_time
+        print("Downloaded {} images ({} failed), {:.1f} images/sec, {:.2f} MB/sec".format(
+            num_success, num_failed, (num_success + num_failed) / elapsed, total_bytes / elapsed / 1e6))
+
+    with DownloadJournal(download_dir) as journal:
+
+        # Submit downloads lazily, keeping at most 2 * num_workers of them in flight
+        pending = pending_downloads(image_urls, download_dir, journal, is_dead)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = set()
+            while True:
+                for download_args in pending:
+                    futures.add(executor.submit(download, journal, *download_args))
+                    if len(futures) >= 2 * num_workers:
+                        break
+                if len(futures) == 0:
+                    break
+
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    success, num_bytes = future.result()
+                    num_success += success
+                    num_failed += not success
+                    total_bytes += num_bytes
+                    if (num_success + num_failed) % 100 == 0:
+                        report()
+
+    if num_success + num_failed > 0:
+        report()
+
+    return num_success, num_failed
 
 
 def delete_error_files(download_dir):
     """
-    Delete error files, i.e. images that failed to download.
+    Delete error files, i.e. files of images that failed to download: leftover partial
+    downloads, and error files of old downloads (before the journal) that failed.
 
     Args:
         download_dir: The directory where the images are saved.
     """
-    
+
     num_errors_files = 0
-    index = 0
-    notexist_tally = 0
 
-    while notexist_tally < 10:  # XXX: bad heuristic check
-        # Create image name and path
-        image_name = IMAGE_NAME_FORMAT(index)
-        image_path = os.path.join(download_dir, image_name)
+    with DownloadJournal(download_dir) as journal:
+        for entry in os.scandir(download_dir):
+            if not entry.is_file() or entry.name == JOURNAL:
+                continue
 
-        # Delete error file, if any
-        if os.path.exists(image_path):
-            notexist_tally = 0
-            with open(image_path, "rb") as image:
-                if IS_ERROR_FILE(image):
-                    print("Removing %s" % image_name)
-                    os.remove(image_path)
-                    num_errors_files += 1
-        else:
-            notexist_tally += 1
+            if entry.name.endswith(PARTIAL_EXT):
+                is_error_file = True
+            elif entry.name.isdigit() and journal.get(int(entry.name)) is not None:
+                is_error_file = journal.get(int(entry.name))["status"] == "error"
+            else:
+                with open(entry.path, "rb") as image:
+                    is_error_file = IS_ERROR_FILE(image)
 
-        index += 1
+            if is_error_file:
+                print("Removing %s" % entry.name)
+                os.remove(entry.path)
+                num_errors_files += 1
 
     print("Deleted %d error files." % num_errors_files)
     return num_errors_files
@@ -123,10 +381,18 @@ def main(args):
     if not os.path.isdir(args.download_dir):
         os.mkdir(args.download_dir)
 
+    # Skip the urls known to be dead by probe_urls.py, if any
+    is_dead = None
+    if args.probes is not None:
+        from probe_urls import ProbeCache
+        with ProbeCache(args.probes) as cache:
+            is_dead = cache.is_dead
+
     # Download images
     with open(args.image_urls, "r") as f:
         image_urls = (line.rstrip() for line in f)
-        download_images(image_urls, args.download_dir)
+        normalize = {"max_side": args.max_side, "quality": args.quality} if args.normalize else None
+        download_images(image_urls, args.download_dir, args.workers, args.retries, normalize=normalize, is_dead=is_dead)
 
     delete_error_files(args.download_dir)
 
@@ -136,13 +402,24 @@ def main(args):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Download images from a file of image urls.")
-    
+
     parser.add_argument("-o", "--download_dir", type=str, default=DOWNLOAD_DIR,
         help="the directory where the images will be downloaded.")
     parser.add_argument("-i", "--image_urls", type=str, default=IMAGE_URLS,
         help="the output file where the urls of the images are saved.")
-    
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+        help="number of concurrent downloads.")
+    parser.add_argument("--retries", type=int, default=NUM_RETRIES,
+        help="number of retries of a request that fails with a transient error (connection, 429, 5xx).")
+    parser.add_argument("--normalize", action="store_true",
+        help="validate downloaded images, and re-encode them as JPEG downscaled to --max_side.")
+    parser.add_argument("--max_side", type=int, default=MAX_SIDE,
+        help="the longest side of normalized images (0 for no limit).")
+    parser.add_argument("--quality", type=int, default=QUALITY,
+        help="the JPEG quality of normalized images.")
+    parser.add_argument("--probes", type=str, default=None,
+        help="the cache of probe_urls.py, to skip the urls known to be dead.")
+
     args = parser.parse_args()
 
     main(args)
-
@@ -0,0 +1,280 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+from PIL import Image
+
+try:
+    from face_recognition import face_landmarks
+except ImportError:
+    face_landmarks = None
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATASET_DIR = os.path.join(FILE_DIR, "data", "instagram")
+
+# The names of the store's files in the dataset directory
+LANDMARKS_DATA = "landmarks.float32"
+LANDMARKS_INDEX = "landmarks.json"
+LANDMARKS_SIZE = [72, 2]
+
+# The directory (relative to an image's directory) where extract_faces.py pickles landmarks
+PICKLED_LANDMARKS_DIR = "landmarks"
+
+
+def dict_to_list(d):
+    return [x for l in d.values() for x in l]
+
+
+def image_dirs_of(dataset_dir):
+    """
+    Return the directories of images in `dataset_dir`, which are either its
+    `nomakeup` and `makeup` directories (MakeupDataset2) or itself (MakeupDataset).
+    """
+    domain_dirs = [os.path.join(dataset_dir, d) for d in ("nomakeup", "makeup")]
+    domain_dirs = [d for d in domain_dirs if os.path.isdir(d)]
+    return domain_dirs if domain_dirs else [dataset_dir]
+
+
+def pickled_landmarks_path(image_path):
+    """
+    Get the path of the landmarks pickled by `extract_faces.extract_landmarks` for an image.
+    """
+    image_dir, file_name = os.path.split(image_path)
+    pickle_name = file_name.split(".")[0] + ".pickle"
+    return os.path.join(image_dir, PICKLED_LANDMARKS_DIR, pickle_name)
+
+
+def load_pickled_landmarks(image_path):
+    """
+    Load the landmarks pickled by `extract_faces.extract_landmarks` for an image, if any.
+
+    Args:
+        image_path: The path of the face image.
+
+    Returns:
+        The landmarks as a list of (x, y) points, or None if they were not pickled.
+    """
+    pickle_path = pickled_landmarks_path(image_path)
+
+    if not os.path.isfile(pickle_path):
+        return None
+
+    with open(pickle_path, "rb") as f:
+        return dict_to_list(pickle.load(f))
+
+
+def detect_landmarks(image):
+    """
+    Detect the landmarks of the first face in a PIL image.
+
+    Returns:
+        The landmarks as a list of (x, y) points, or None if no face was found.
+    """
+    if face_landmarks is None:
+        raise NotImplementedError("face_recognition module is not available.")
+
+    landmarks_found = face_landmarks(np.array(image))
+    return dict_to_list(landmarks_found[0]) if len(landmarks_found) > 0 else None
+
+
+def normalized_landmarks(image_path, detect=False):
+    """
+    Get the landmarks of an image in coordinates normalized by its width and height.
+    Pickled landmarks are used if they exist, otherwise they are detected if `detect`.
+
+    Args:
+        image_path: The path of the face image.
+        detect: Detect the landmarks of images which have no pickled landmarks.
+
+    Returns:
+        A float32 array of size LANDMARKS_SIZE, all zeros if no landmarks were found.
+    """
+
+    landmarks = np.zeros(LANDMARKS_SIZE, dtype=np.float32)
+
+    with Image.open(image_path) as image:
+        points = load_pickled_landmarks(image_path)
+        if points is None and detect:
+            points = detect_landmarks(image.convert("RGB"))
+
+        if points is not None and len(points) == LANDMARKS_SIZE[0]:
+            landmarks[:] = points
+            landmarks /= np.array(image.size, dtype=np.float32)
+
+    return landmarks
+
+
+def build_landmarks_store(dataset_dir, detect=False):
+    """
+    Build (or update) the landmarks store of the images in `dataset_dir`.
+    Landmarks of images whose mtime (and the mtime of their pickled landmarks) did not change
+    since the last build are reused, unless they were not found and may be detected now.
+
+    Args:
+        dataset_dir: The directory of the dataset.
+        detect: Detect the landmarks of images which have no pickled landmarks.
+
+    Returns:
+        The number of images whose landmarks were (re)computed.
+    """
+
+    data_path = os.path.join(dataset_dir, LANDMARKS_DATA)
+    index_path = os.path.join(dataset_dir, LANDMARKS_INDEX)
+
+    # Reuse the landmarks of unchanged images
+    old_entries, old_landmarks, old_detect = {}, None, False
+    if os.path.isfile(index_path) and os.path.isfile(data_path):
+        with open(index_path, "r") as f:
+            old_index = json.load(f)
+        old_entries = old_index["entries"]
+        old_landmarks = np.memmap(data_path, dtype=np.float32, mode="r", shape=tuple(old_index["shape"]))
+        old_detect = old_index.get("detect", False)
+
+    image_paths = sorted(os.path.join(image_dir, f)
+                         for image_dir in image_dirs_of(dataset_dir)
+                         for f in os.listdir(image_dir)
+                         if f[0] != "." and os.path.isfile(os.path.join(image_dir, f))
+                         and not f.startswith((LANDMARKS_DATA, LANDMARKS_INDEX)))  # the store itself in flat datasets
+
+    entries = {}
+    all_landmarks = np.zeros([len(image_paths)] + LANDMARKS_SIZE, dtype=np.float32)
+    num_computed = 0
+
+    for row, image_path in enumerate(image_paths):
+        relpath = os.path.relpath(image_path, dataset_dir)
+        pickle_path = pickled_landmarks_path(image_path)
+        mtime = os.path.getmtime(image_path)
+        pickle_mtime = os.path.getmtime(pickle_path) if os.path.isfile(pickle_path) else None
+        entries[relpath] = [row, mtime, pickle_mtime]
+
+        old_entry = old_entries.get(relpath)
+        if old_entry is not None and old_entry[1:] == [mtime, pickle_mtime]:
+            landmarks = old_landmarks[old_entry[0]]
+            # Landmarks that were not found are detected if the last build didn't try to
+            if landmarks.any() or old_detect or not detect:
+                all_landmarks[row] = landmarks
+                continue
+
+        try:
+            all_landmarks[row] = normalized_landmarks(image_path, detect)
+            num_computed += 1
+        except Exception as e:
+            print("Failed to get landmarks of {}: {}".format(image_path, e))
+
+    del old_landmarks  # unmap the old store before replacing it
+
+    # Write to temporary files and replace the old store (index last, so it is never stale)
+    all_landmarks.tofile(data_path + ".tmp")
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"shape": list(all_landmarks.shape), "detect": detect, "entries": entries}, f)
+
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(index_path + ".tmp", index_path)
+
+    return num_computed
+
+
+class LandmarksStore:
+    """Read-only, memory-mapped landmarks of the images of a dataset, as built by `build_landmarks_store`."""
+
+    def __init__(self, dataset_dir):
+        """
+        Initializes LandmarksStore. Entries of images that were modified after
+        the store was built are dropped (their landmarks would be stale).
+
+        Args:
+            dataset_dir: The directory of the dataset.
+        """
+
+        index_path = os.path.join(dataset_dir, LANDMARKS_INDEX)
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError(f"Landmarks store '{index_path}' does not exist. "
+                                    f"Run `python landmarks.py` first.")
+
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        self.rows = {}
+        for relpath, entry in index["entries"].items():
+            row, mtime = entry[:2]
+            path = os.path.join(dataset_dir, relpath)
+            if os.path.isfile(path) and os.path.getmtime(path) == mtime:
+                self.rows[path] = row
+
+        self.data_path = os.path.join(dataset_dir, LANDMARKS_DATA)
+        self.shape = tuple(index["shape"])
+        self._landmarks = None  # mapped lazily, once per (worker) process
+
+
+    def __getstate__(self):
+        # Don't pickle the mapped array with the dataset (e.g. to spawned workers)
+        state = self.__dict__.copy()
+        state["_landmarks"] = None
+        return state
+
+
+    @property
+    def landmarks(self):
+        if self._landmarks is None:
+            self._landmarks = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=self.shape)
+        return self._landmarks
+
+
+    def __contains__(self, path):
+        return path in self.rows
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def normalized(self, path):
+        """
+        Get the landmarks of the image in `path`, normalized by the image's width and height.
+
+        Args:
+            path: The path of the image.
+
+        Returns:
+            The landmarks as a float32 array of size LANDMARKS_SIZE.
+        """
+        return np.array(self.landmarks[self.rows[path]])
+
+
+    def scaled(self, path, width, height):
+        """
+        Get the landmarks of the image in `path`, scaled to an image of size (width x height).
+
+        Args:
+            path: The path of the image.
+            width: The width of the image.
+            height: The height of the image.
+
+        Returns:
+            The landmarks as an int32 array of size LANDMARKS_SIZE (all zeros if no face was found).
+        """
+        landmarks = self.normalized(path) * np.array([width, height], dtype=np.float32)
+        return landmarks.round().astype(np.int32)
+
+
+def main(args):
+    num_computed = build_landmarks_store(args.dataset_dir, args.detect)
+    print("Computed landmarks of {} images.".format(num_computed))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Build a memory-mapped store of the face landmarks of a dataset.")
+
+    parser.add_argument("--dataset_dir", type=str, default=DATASET_DIR,
+        help="directory of the dataset (containing 'makeup' and 'nomakeup' directories, if any).")
+    parser.add_argument("--detect", action="store_true",
+        help="detect the landmarks of images that have no landmarks pickled by extract_faces.py.")
+
+    args = parser.parse_args()
+
+    main(args)
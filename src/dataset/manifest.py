@@ -0,0 +1,265 @@
+import os
+import json
+import hashlib
+import argparse
+from PIL import Image
+
+from .landmarks import LandmarksStore, LANDMARKS_INDEX, image_dirs_of, load_pickled_landmarks
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATASET_DIR = os.path.join(FILE_DIR, "data", "instagram")
+
+# The name of the manifest file in the dataset directory
+MANIFEST = "manifest.json"
+
+
+def image_domain(image_dir, file_name):
+    """
+    Get the domain of an image, which is the name of its directory for MakeupDataset2
+    ("nomakeup" or "makeup"), or "before"/"after" from its name for MakeupDataset.
+    """
+    domain = os.path.basename(os.path.normpath(image_dir))
+    if domain in ("nomakeup", "makeup"):
+        return domain
+    if file_name.find("before") != -1:
+        return "before"
+    if file_name.find("after") != -1:
+        return "after"
+    return None
+
+
+def matches(entry, filters):
+    """
+    Check whether a manifest entry matches `filters`, which is a dict of required values
+    of the entry's fields (e.g. {"has_landmarks": True}), and of the special fields
+    "min_side" and "max_short_side", the lower and upper bounds of the smaller side of the image.
+
+    Args:
+        entry: The entry of an image in the manifest.
+        filters: The filters as a dict.
+
+    Returns:
+        True if the entry matches all filters.
+    """
+    for field, value in filters.items():
+        if field == "min_side":
+            if min(entry["width"], entry["height"]) < value: return False
+        elif field == "max_short_side":
+            if min(entry["width"], entry["height"]) > value: return False
+        elif entry.get(field) != value:
+            return False
+    return True
+
+
+class Manifest:
+    """
+    A manifest of the images of a dataset (path, size, mtime, pixel dimensions, domain,
+    and landmarks presence), stored in one file in the dataset directory.
+    """
+
+    def __init__(self, dataset_dir, refresh=True):
+        """
+        Initializes Manifest by loading it, and refreshing it if needed.
+
+        Args:
+            dataset_dir: The directory of the dataset.
+            refresh: Refresh the entries of directories whose mtime changed since the last refresh.
+                     Use `refresh(full=True)` to detect images that were modified in place.
+        """
+
+        self.dataset_dir = dataset_dir
+        self.path = os.path.join(dataset_dir, MANIFEST)
+        self.entries = {}  # relative path -> entry
+        self.dir_mtimes = {}  # relative image directory -> signature (see `dir_signature`) at the last scan
+        self.landmarks_mtime = None  # mtime of the landmarks store at the last scan
+
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            self.entries = manifest["entries"]
+            self.dir_mtimes = manifest["dir_mtimes"]
+            self.landmarks_mtime = manifest["landmarks_mtime"]
+
+        if refresh and self.refresh():
+            self.save()
+
+
+    def refresh(self, full=False):
+        """
+        Rescan the image directories whose mtime changed (i.e. images were added, removed,
+        or renamed), and read the headers of new or modified images only.
+
+        Args:
+            full: Rescan all image directories, to detect images modified in place as well.
+
+        Returns:
+            True if the manifest changed.
+        """
+
+        landmarks_mtime = None
+        landmarks_index = os.path.join(self.dataset_dir, LANDMARKS_INDEX)
+        if os.path.isfile(landmarks_index):
+            landmarks_mtime = os.path.getmtime(landmarks_index)
+
+        # The landmarks store is loaded only if it was rebuilt or a directory is rescanned
+        landmarks_store = None
+        def get_landmarks_store():
+            nonlocal landmarks_store
+            if landmarks_store is None and landmarks_mtime is not None:
+                landmarks_store = LandmarksStore(self.dataset_dir)
+            return landmarks_store
+
+        changed = False
+
+        # Update landmarks presence of all images if the landmarks store was rebuilt
+        if landmarks_mtime != self.landmarks_mtime and landmarks_mtime is not None:
+            landmarks_store = get_landmarks_store()
+            for relpath, entry in self.entries.items():
+                path = os.path.join(self.dataset_dir, relpath)
+                if path in landmarks_store:
+                    entry["has_landmarks"] = bool(landmarks_store.normalized(path).any())
+            changed = True
+        self.landmarks_mtime = landmarks_mtime
+
+        for image_dir in image_dirs_of(self.dataset_dir):
+            rel_dir = os.path.relpath(image_dir, self.dataset_dir)
+            signature = self.dir_signature(image_dir)
+            if not full and self.dir_mtimes.get(rel_dir) == signature:
+                continue
+
+            changed |= self.scan(image_dir, get_landmarks_store())
+            self.dir_mtimes[rel_dir] = signature
+
+        return changed
+
+
+    def dir_signature(self, image_dir):
+        """
+        Get the signature of an image directory, which changes when images are added, removed,
+        or renamed: its mtime, or, for the dataset directory itself (MakeupDataset), a hash of its
+        file names, since saving the manifest in the directory changes its mtime.
+        """
+        if os.path.normpath(image_dir) != os.path.normpath(self.dataset_dir):
+            return os.path.getmtime(image_dir)
+
+        names = sorted(name for name in os.listdir(image_dir) if not name.startswith(MANIFEST))
+        return hashlib.sha1("\n".join(names).encode("utf-8")).hexdigest()
+
+
+    def scan(self, image_dir, landmarks_store=None):
+        """
+        Scan an image directory and update the entries of its images.
+
+        Returns:
+            True if any entry changed.
+        """
+
+        rel_dir = os.path.relpath(image_dir, self.dataset_dir)
+        old_paths = {p for p in self.entries if (os.path.dirname(p) or ".") == rel_dir}
+        changed = False
+
+        for dir_entry in os.scandir(image_dir):
+            if dir_entry.name[0] == "." or not dir_entry.is_file():
+                continue
+
+            # Files of no domain (e.g. this manifest in a MakeupDataset directory) aren't images
+            domain = image_domain(image_dir, dir_entry.name)
+            if domain is None:
+                continue
+
+            relpath = os.path.relpath(dir_entry.path, self.dataset_dir)
+            old_paths.discard(relpath)
+
+            stat = dir_entry.stat()
+            entry = self.entries.get(relpath)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+
+            try:
+                with Image.open(dir_entry.path) as image:
+                    width, height = image.size
+            except Exception as e:
+                print("Skipping {}: {}".format(dir_entry.path, e))
+                continue
+
+            if landmarks_store is not None and dir_entry.path in landmarks_store:
+                has_landmarks = bool(landmarks_store.normalized(dir_entry.path).any())
+            else:
+                has_landmarks = load_pickled_landmarks(dir_entry.path) is not None
+
+            self.entries[relpath] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "width": width,
+                "height": height,
+                "domain": domain,
+                "has_landmarks": has_landmarks,
+            }
+            changed = True
+
+        # Forget the images that were removed
+        for relpath in old_paths:
+            del self.entries[relpath]
+            changed = True
+
+        return changed
+
+
+    def save(self):
+        """
+        Saves the manifest atomically (so a crash never leaves a broken manifest).
+        """
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({
+                "entries": self.entries,
+                "dir_mtimes": self.dir_mtimes,
+                "landmarks_mtime": self.landmarks_mtime,
+            }, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+    def paths(self, domain, filters=None):
+        """
+        Get the sorted paths of the images of `domain` that match `filters` (see `matches`).
+
+        Args:
+            domain: The domain of the images.
+            filters: The filters of the images as a dict.
+
+        Returns:
+            A sorted list of the paths of the images.
+        """
+        return sorted(os.path.join(self.dataset_dir, relpath)
+                      for relpath, entry in self.entries.items()
+                      if entry["domain"] == domain and matches(entry, filters or {}))
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.dataset_dir)
+
+
+def main(args):
+    manifest = Manifest(args.dataset_dir, refresh=False)
+    if manifest.refresh(full=args.full):
+        manifest.save()
+    print("Manifest has {} images.".format(len(manifest)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Build or refresh the manifest of a dataset.")
+
+    parser.add_argument("--dataset_dir", type=str, default=DATASET_DIR,
+        help="directory of the dataset (containing 'makeup' and 'nomakeup' directories, if any).")
+    parser.add_argument("--full", action="store_true",
+        help="rescan all directories, to detect images that were modified in place.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,167 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATASET_DIR = os.path.join(FILE_DIR, "data", "instagram")
+
+# The domains (sub-directories) of MakeupDataset2 that are packed
+DOMAINS = ("nomakeup", "makeup")
+
+# The names of the packed files of a domain at a given image size
+PACKED_DIR = "packed"
+PACKED_DATA_FORMAT = lambda domain, image_size: "{}-{}.uint8".format(domain, image_size)
+PACKED_INDEX_FORMAT = lambda domain, image_size: "{}-{}.json".format(domain, image_size)
+
+
+def pack_domain(domain_dir, image_size, data_path, index_path):
+    """
+    Decode and resize all images in `domain_dir` and write them as one
+    contiguous array of shape [N, image_size, image_size, 3] in uint8.
+
+    Args:
+        domain_dir: Directory of the images of the domain (e.g. "makeup").
+        image_size: Images are resized to (image_size x image_size).
+        data_path: The path of the raw packed images.
+        index_path: The path of the index (shape and file names) of the packed images.
+
+    Returns:
+        The number of packed images.
+    """
+
+    file_names = sorted(f for f in os.listdir(domain_dir) if f[0] != "."
+                        and os.path.isfile(os.path.join(domain_dir, f)))
+
+    # Images are appended one after another, so failed images leave no holes
+    packed_names = []
+    with open(data_path, "wb") as f:
+        for file_name in file_names:
+            try:
+                image = Image.open(os.path.join(domain_dir, file_name)).convert("RGB")
+                image = image.resize((image_size, image_size), Image.BILINEAR)
+            except Exception as e:
+                print("Failed to pack {}: {}".format(file_name, e))
+                continue
+
+            f.write(np.asarray(image, dtype=np.uint8).tobytes())
+            packed_names.append(file_name)
+
+    # Write the index last, so a partially written pack is never loaded
+    index = {
+        "shape": [len(packed_names), image_size, image_size, 3],
+        "files": packed_names,
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+
+    return len(packed_names)
+
+
+def pack_images(dataset_dir, image_size):
+    """
+    Pack the `nomakeup` and `makeup` images of a MakeupDataset2 directory
+    into `dataset_dir/packed`, to be read by `MakeupDataset2(packed=True)`.
+
+    Args:
+        dataset_dir: The directory of the dataset.
+        image_size: Images are resized to (image_size x image_size).
+    """
+
+    packed_dir = os.path.join(dataset_dir, PACKED_DIR)
+    if not os.path.isdir(packed_dir): os.mkdir(packed_dir)
+
+    for domain in DOMAINS:
+        print("Packing '{}' images at size {}... ".format(domain, image_size))
+        num_packed = pack_domain(os.path.join(dataset_dir, domain), image_size,
+                                 os.path.join(packed_dir, PACKED_DATA_FORMAT(domain, image_size)),
+                                 os.path.join(packed_dir, PACKED_INDEX_FORMAT(domain, image_size)))
+        print("Packed {} images.".format(num_packed))
+
+
+class PackedImages:
+    """Read-only, memory-mapped view of the images packed by `pack_images`."""
+
+    def __init__(self, dataset_dir, domain, image_size):
+        """
+        Initializes PackedImages.
+
+        Args:
+            dataset_dir: The directory of the dataset.
+            domain: The domain of the images (e.g. "makeup").
+            image_size: The size at which the images were packed.
+        """
+
+        packed_dir = os.path.join(dataset_dir, PACKED_DIR)
+        data_path = os.path.join(packed_dir, PACKED_DATA_FORMAT(domain, image_size))
+        index_path = os.path.join(packed_dir, PACKED_INDEX_FORMAT(domain, image_size))
+
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError(f"Packed images '{index_path}' do not exist. "
+                                    f"Run `python packed.py --image_size {image_size}` first.")
+
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        domain_dir = os.path.join(dataset_dir, domain)
+        self.rows = {os.path.join(domain_dir, name): row for row, name in enumerate(index["files"])}
+        self.data_path = data_path
+        self.shape = tuple(index["shape"])
+        self._images = None  # mapped lazily, once per (worker) process
+
+
+    def __getstate__(self):
+        # Don't pickle the mapped array with the dataset (e.g. to spawned workers)
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=self.shape)
+        return self._images
+
+
+    def __contains__(self, path):
+        return path in self.rows
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __getitem__(self, path):
+        """
+        Get the packed image of `path` as a PIL image.
+
+        Args:
+            path: The original path of the image.
+
+        Returns:
+            The image in PIL format.
+        """
+        return Image.fromarray(np.array(self.images[self.rows[path]]))
+
+
+def main(args):
+    for image_size in args.image_size:
+        pack_images(args.dataset_dir, image_size)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Pack decoded and resized images for MakeupDataset2.")
+
+    parser.add_argument("--dataset_dir", type=str, default=DATASET_DIR,
+        help="directory of the dataset containing the 'makeup' and 'nomakeup' directories.")
+    parser.add_argument("--image_size", type=int, nargs="+", default=[128],
+        help="sizes at which the images will be packed.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from download_images import get_session, is_retryable, IMAGE_URLS, NUM_RETRIES, BACKOFF, RETRY_STATUS_CODES
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# The cache of the probes (JSON lines), shared by all the files of urls
+PROBE_CACHE = os.path.join(FILE_DIR, "data", "probes.jsonl")
+
+# The classes of probed urls
+ALIVE = "alive"          # the url serves an image
+DEAD = "dead"            # the url fails with a client error (e.g. 404, or an expired CDN signature)
+NOT_IMAGE = "not_image"  # the url (or the url it redirects to) serves something else, e.g. a login page
+ERROR = "error"          # the url failed with a transient error (timeouts, 5xx, ...) even after retries
+
+# Dead urls (and urls that aren't images) are never probed again, other urls are re-probed after MAX_AGE
+FINAL_STATUSES = {DEAD, NOT_IMAGE}
+MAX_AGE = 7 * 24 * 3600
+
+NUM_WORKERS = 64  # number of concurrent probes
+PROBE_TIMEOUT = 10
+SNIFF_SIZE = 16  # number of bytes requested to check the signature of an image
+RANGE_FALLBACK_CODES = {403, 405, 501}  # codes of servers that may refuse HEAD requests (but not GET)
+
+
+class ProbeCache:
+    """
+    An append-only cache (JSON lines) of the probe of each url, which records the url, the
+    status (see ALIVE, DEAD, NOT_IMAGE and ERROR), the http code, the final url (after redirects),
+    the content type and the time of the probe. The last record of a url wins.
+    """
+
+    def __init__(self, path=PROBE_CACHE):
+        self.path = path
+        self.records = {}  # url -> last record
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write of a crash
+                    self.records[record["url"]] = record
+
+        self.file = open(self.path, "a")
+
+
+    def record(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[record["url"]] = record
+
+
+    def get(self, url, max_age=MAX_AGE):
+        """
+        Get the last record of `url`, or None if it has none (or if it expired).
+        """
+        record = self.records.get(url)
+        if record is None:
+            return None
+        if record["status"] not in FINAL_STATUSES and time.time() - record["time"] > max_age:
+            return None
+        return record
+
+
+    def is_dead(self, url):
+        """
+        Check whether `url` is known to be dead (or not to be an image).
+        """
+        record = self.records.get(url)
+        return record is not None and record["status"] in FINAL_STATUSES
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def is_image_signature(data):
+    """
+    Check whether `data` starts with the signature of a JPEG, PNG, GIF or WebP image.
+    """
+    return (data.startswith((b"\xff\xd8\xff", b"\x89PNG", b"GIF8"))
+            or (data[:4] == b"RIFF" and data[8:12] == b"WEBP"))
+
+
+def content_type_of(response):
+    return response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+
+def probe_url(url, timeout=PROBE_TIMEOUT, retries=NUM_RETRIES, backoff=BACKOFF):
+    """
+    Probe a url with a HEAD request, without downloading the image. If the server refuses
+    HEAD requests, or doesn't say that the content is an image, the first bytes of the
+    content are requested (with a range request) to check its signature.
+
+    Args:
+        url: The url of the image.
+        timeout: The timeout of the requests, in seconds.
+        retries: Number of retries if a request fails with a transient error.
+        backoff: The base of the exponential backoff between retries, in seconds.
+
+    Returns:
+        The record of the probe.
+    """
+
+    record = {"url": url, "status": ERROR, "code": None, "final_url": None, "content_type": None, "error": None}
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            response = session.head(url, allow_redirects=True, timeout=timeout)
+            response.close()
+            content_type = content_type_of(response)
+
+            is_image = response.ok and content_type.startswith("image/")
+            if not is_image and (response.ok or response.status_code in RANGE_FALLBACK_CODES):
+                headers = {"Range": "bytes=0-{}".format(SNIFF_SIZE - 1)}
+                with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    content_type = content_type_of(response)
+                    if response.ok:
+                        data = response.raw.read(SNIFF_SIZE, decode_content=True)
+                        is_image = content_type.startswith("image/") or is_image_signature(data)
+
+            if response.status_code in RETRY_STATUS_CODES:
+                response.raise_for_status()
+            record.update(code=response.status_code, final_url=response.url, content_type=content_type)
+            if is_image:
+                record["status"] = ALIVE
+            elif response.ok:
+                record["status"] = NOT_IMAGE
+            else:
+                record["status"] = DEAD
+            break
+
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                record["error"] = "{}: {}".format(type(e).__name__, e)
+                if isinstance(e, requests.HTTPError) and e.response is not None:
+                    record["code"] = e.response.status_code
+                elif isinstance(e, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                                    requests.exceptions.InvalidSchema)):
+                    record["status"] = DEAD
+                break
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+    record["time"] = time.time()
+    return record
+
+
+def probe_urls(image_urls, cache, num_workers=NUM_WORKERS, max_age=MAX_AGE, timeout=PROBE_TIMEOUT):
+    """
+    Probe the urls of `image_urls` that have no (unexpired) probe in `cache`, with at most
+    `num_workers` concurrent probes, and record the probes in `cache`.
+
+    Args:
+        image_urls: The urls of the images.
+        cache: The ProbeCache of the probes.
+        num_workers: Number of concurrent probes.
+        max_age: The age (in seconds) of the probes of urls that aren't dead after which they are probed again.
+        timeout: The timeout of the requests, in seconds.
+
+    Returns:
+        A Counter of the statuses of the urls.
+    """
+
+    statuses = collections.Counter()
+    start_time = time.time()
+    num_probed = 0
+
+    def pending():
+        for image_url in image_urls:
+            record = cache.get(image_url, max_age)
+            if record is None:
+                yield image_url
+            else:
+                statuses[record["status"]] += 1
+
+    # Submit probes lazily, keeping at most 2 * num_workers of them in flight
+    urls = pending()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = set()
+        while True:
+            for image_url in urls:
+                futures.add(executor.submit(probe_url, image_url, timeout))
+                if len(futures) >= 2 * num_workers:
+                    break
+            if len(futures) == 0:
+                break
+
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                cache.record(record)
+                statuses[record["status"]] += 1
+                num_probed += 1
+                if num_probed % 1000 == 0:
+                    print("Probed {} urls, {:.1f} urls/sec".format(num_probed, num_probed / (time.time() - start_time)))
+
+    print("Probed {} urls ({} cached): {}".format(num_probed, sum(statuses.values()) - num_probed,
+        ", ".join("{} {}".format(n, status) for status, n in statuses.most_common())))
+
+    return statuses
+
+
+def main(args):
+
+    with open(args.image_urls, "r") as f:
+        image_urls = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    with ProbeCache(args.cache) as cache:
+        probe_urls(image_urls, cache, args.workers, args.max_age * 24 * 3600, args.timeout)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                f.writelines(url + "\n" for url in image_urls if cache.records[url]["status"] == ALIVE)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Probe image urls (without downloading them) to find dead urls before downloading.")
+
+    parser.add_argument("-i", "--image_urls", type=str, default=IMAGE_URLS,
+        help="the file of the urls of the images.")
+    parser.add_argument("--cache", type=str, default=PROBE_CACHE,
+        help="the cache of the probes; dead urls in the cache are skipped by download_images.py --probes.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+        help="write the urls that are alive to this file, if given.")
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+        help="number of concurrent probes.")
+    parser.add_argument("--max_age", type=float, default=MAX_AGE / (24 * 3600),
+        help="age in days of the probes of urls that aren't dead after which they are probed again.")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT,
+        help="timeout of the requests in seconds.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,90 @@
+import torch
+import torch.utils.data as data_utils
+
+
+class UnpairedSampler(data_utils.Sampler):
+    """
+    Samples (before, after) index pairs of MakeupDataset from independent permutations
+    of the before and after images, reshuffled every epoch from a seed.
+    """
+
+    def __init__(self, num_before, num_after, cover_larger=True, shuffle=True, seed=0):
+        """
+        Initializes UnpairedSampler.
+
+        Args:
+            num_before: Number of before images.
+            num_after: Number of after images.
+            cover_larger: Sample every image of the larger domain each epoch, repeating the
+                          smaller domain as needed, instead of stopping at the smaller one.
+            shuffle: Shuffle the images every epoch. Otherwise, pair them in order.
+            seed: Seed of the permutations (the permutations of epoch `e` are seeded by `seed + e`).
+        """
+        self.num_before = num_before
+        self.num_after = num_after
+        self.cover_larger = cover_larger
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch of the sampler, which determines its permutations.
+
+        Args:
+            epoch: The current epoch.
+        """
+        self.epoch = epoch
+
+
+    def indices(self, num_images, generator):
+        """
+        Returns `len(self)` indices of `num_images` images, in (repeated) permutations.
+        """
+        num_repeats = -(-len(self) // num_images)  # ceil
+        if self.shuffle:
+            indices = [torch.randperm(num_images, generator=generator) for _ in range(num_repeats)]
+        else:
+            indices = [torch.arange(num_images) for _ in range(num_repeats)]
+        return torch.cat(indices)[:len(self)].tolist()
+
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indices_before = self.indices(self.num_before, generator)
+        indices_after = self.indices(self.num_after, generator)
+
+        return iter(zip(indices_before, indices_after))
+
+
+    def __len__(self):
+        if self.cover_larger:
+            return max(self.num_before, self.num_after)
+        return min(self.num_before, self.num_after)
+
+
+class PairedSampler(UnpairedSampler):
+    """Samples (i, i) index pairs of a paired MakeupDataset, reshuffled every epoch from a seed."""
+
+    def __init__(self, num_pairs, shuffle=True, seed=0):
+        """
+        Initializes PairedSampler.
+
+        Args:
+            num_pairs: Number of (before, after) pairs.
+            shuffle: Shuffle the pairs every epoch.
+            seed: Seed of the permutations (the permutation of epoch `e` is seeded by `seed + e`).
+        """
+        super().__init__(num_pairs, num_pairs, cover_larger=False, shuffle=shuffle, seed=seed)
+
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indices = self.indices(self.num_before, generator)
+
+        return iter(zip(indices, indices))
@@ -1,14 +1,23 @@
-
 import os
 import glob
 import json
 import argparse
+from multiprocessing import Pool
+
+from ..url_sink import UrlSink, BATCH_SIZE
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
-HASHTAG_DIR="third_party/instagram-hashtag-crawler/hashtags"
-IMAGE_URL_CSV="instagram_urls.csv"
+HASHTAG_DIR=os.path.join(FILE_DIR, "third_party/instagram-hashtag-crawler/hashtags")
+IMAGE_URL_CSV=os.path.join(FILE_DIR, "instagram_urls.csv")
 LOW_RES=1
 HIGH_RES=0
 
+NUM_WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 1 << 20  # number of characters read at a time from a crawl file
+SEPARATORS = " \t\n\r,"
+
 def get_post_image_urls(post, res=HIGH_RES):
     if "image_versions2" in post:
         return [post["image_versions2"]["candidates"][res]["url"]]
@@ -18,37 +27,118 @@ def get_post_image_urls(post, res=HIGH_RES):
     else:
         return []
 
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """
+    A generator that parses the elements of the JSON array of a file one by one,
+    so that only one element (and one chunk of the file) is in memory at a time.
+    Elements may span chunks, including scalars (e.g. a number split by a chunk boundary).
+
+    Args:
+        f: The file, opened in text mode.
+        chunk_size: Number of characters read at a time.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+    started = False
+    while True:
+        # Skip the whitespace (and the commas between the elements)
+        while pos < len(buffer) and buffer[pos] in SEPARATORS:
+            pos += 1
+        if pos == len(buffer):
+            buffer, pos = f.read(chunk_size), 0
+            if not buffer:
+                raise ValueError("Unterminated JSON array in {}".format(f.name))
+            continue
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array in {}".format(f.name))
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The element continues in the next chunk
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        # A scalar that reaches the end of the buffer (or isn't followed by a separator, like
+        # "1." of "1.5") may continue in the next chunk, so decode it again with the next chunk
+        if end == len(buffer) or buffer[end] not in SEPARATORS + "]":
+            chunk = f.read(chunk_size)
+            if chunk:
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+        yield element
+        pos = end
+
+def extract_file_urls(json_path):
+    """
+    Extract the image urls of the posts of a crawl file.
+
+    Returns:
+        The path of the file, its image urls (without duplicates), and the error if any.
+    """
+    image_urls = {}  # an ordered set
+    try:
+        with open(json_path, "r") as json_f:
+            for post in iter_json_array(json_f):
+                image_urls.update(dict.fromkeys(get_post_image_urls(post)))
+    except Exception as e:
+        return json_path, list(image_urls), "{}: {}".format(type(e).__name__, e)
+    return json_path, list(image_urls), None
+
+def harvest_urls(json_paths, sink, workers=NUM_WORKERS):
+    """
+    Extract the image urls of crawl files in parallel, and add them to a url sink
+    as each file is parsed.
+
+    Args:
+        json_paths: The paths of the crawl files.
+        sink: The `UrlSink` of the urls.
+        workers: Number of processes parsing crawl files.
+    """
+    with Pool(workers) as pool:
+        for i, (json_path, image_urls, error) in enumerate(pool.imap_unordered(extract_file_urls, json_paths)):
+            num_new = sink.add(image_urls)
+            print("[{}/{}] {}: {} urls, {} new{}".format(i + 1, len(json_paths), os.path.basename(json_path),
+                len(image_urls), num_new, "" if error is None else " (Error! {})".format(error)))
+
 def main(args):
     # Get JSON files in hashtag-crawling results directory
     json_files = os.path.join(args.hashtag_dir, "*.json")
     hashtag_json_fs = [f for f in glob.glob(json_files) if "rawfeed" in f]
 
-    # Get the posts from each hashtag crawl file
-    hashtag_posts = []
-    for hashtag_json_f in hashtag_json_fs:
-        with open(hashtag_json_f, "r") as json_f:
-            posts = json.load(json_f)
-            hashtag_posts.append(posts)
-    
-    # Get the image url of each post
-    image_urls = [get_post_image_urls(post) for posts in hashtag_posts for post in posts]
-    image_urls = [url for post_urls in image_urls for url in post_urls]  # flatten
-
-    # Write the urls in the output file
-    with open(args.out, "w") as f:
-        f.writelines(image_url+"\n" for image_url in image_urls)
+    # Stream the image urls of the posts of each crawl file into the output file
+    with UrlSink(args.out, append=args.append, batch_size=args.batch_size) as sink:
+        harvest_urls(hashtag_json_fs, sink, args.workers)
+    print("Wrote {} urls to {} ({} duplicates skipped).".format(sink.num_urls, args.out, sink.num_duplicates))
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
         description="Extract URLs of images from the JSON crawl files of instagram-hashtag-crawler.")
-    
+
     parser.add_argument("--hashtag-dir", type=str, default=HASHTAG_DIR,
         help="directory containing hashtag crawling results.")
     parser.add_argument("-o", "--out", type=str, default=IMAGE_URL_CSV,
         help="text file containing image urls.")
-    
+    parser.add_argument("--append", action="store_true",
+        help="append to the output file, skipping the urls it already has.")
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+        help="number of processes parsing crawl files.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+        help="number of urls written to the output file at a time.")
+
     args = parser.parse_args()
 
     main(args)
-
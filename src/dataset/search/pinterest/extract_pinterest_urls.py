@@ -1,23 +1,43 @@
+import os
 import re
+import argparse
 
-def main():
-    pre_p1, post_p1 = "3x, ", " 4x"
-    pre_p2, post_p2 = '"orig": {"url": "', '", "width'
-    p1 = re.compile("(?:"+pre_p1+")" + r"(.*?)" + "(?:"+post_p1+")")
-    p2 = re.compile("(?:"+pre_p2+")" + r"(.*?)" + "(?:"+post_p2+")")
+from ..url_sink import UrlSink
 
-    image_urls = set()
-    for i in range(1,6):
-        pinterest_html = "html_sources/pinterest{}.html".format(i)
-        with open(pinterest_html, "r") as f:
-            html = f.read()
-            image_urls |= set(p1.findall(html))
-            image_urls |= set(p2.findall(html))
-    
-    with open("pinterest_urls.csv", "w") as f:
-        f.writelines(image_url+"\n" for image_url in image_urls)
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+HTML_SOURCES = [os.path.join(FILE_DIR, "html_sources", "pinterest{}.html".format(i)) for i in range(1,6)]
+IMAGE_URL_CSV = os.path.join(FILE_DIR, "pinterest_urls.csv")
+
+pre_p1, post_p1 = "3x, ", " 4x"
+pre_p2, post_p2 = '"orig": {"url": "', '", "width'
+p1 = re.compile("(?:"+pre_p1+")" + r"(.*?)" + "(?:"+post_p1+")")
+p2 = re.compile("(?:"+pre_p2+")" + r"(.*?)" + "(?:"+post_p2+")")
+
+def extract_html_urls(pinterest_html):
+    with open(pinterest_html, "r") as f:
+        html = f.read()
+        return p1.findall(html) + p2.findall(html)
+
+def main(args):
+    with UrlSink(args.out, append=args.append) as sink:
+        for pinterest_html in args.html:
+            sink.add(extract_html_urls(pinterest_html))
+    print("Wrote {} urls to {} ({} duplicates skipped).".format(sink.num_urls, args.out, sink.num_duplicates))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Extract URLs of images from saved Pinterest pages.")
+
+    parser.add_argument("--html", type=str, nargs="+", default=HTML_SOURCES,
+        help="the html sources of the Pinterest pages.")
+    parser.add_argument("-o", "--out", type=str, default=IMAGE_URL_CSV,
+        help="text file containing image urls.")
+    parser.add_argument("--append", action="store_true",
+        help="append to the output file (e.g. the urls of the instagram crawl), skipping the urls it already has.")
+
+    args = parser.parse_args()
+
+    main(args)
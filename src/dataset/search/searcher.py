@@ -2,9 +2,12 @@
 import os
 import sys
 import time
+import random
 import argparse
 import json
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # The search engines we are using
 SEARCH_ENGINES = ("bing", "google")
@@ -12,6 +15,7 @@ SEARCH_ENGINES = ("bing", "google")
 # The endpoints for the API of the search engines
 BING_API_ENDPOINT = "https://api.cognitive.microsoft.com/bing/v7.0/images/search"
 GOOGLE_API_ENDPOINT = "https://www.googleapis.com/customsearch/v1"
+API_ENDPOINTS = {"bing": BING_API_ENDPOINT, "google": GOOGLE_API_ENDPOINT}
 
 # The queries of the image search
 QUERIES = [
@@ -24,13 +28,30 @@ QUERIES = [
 # Search results limit (this limit is soft/approximate)
 MAX_RESULTS = 1e6
 
+# Requests per second (and burst size) allowed by the quota of each search engine
+RATE_LIMITS = {"bing": 2.0, "google": 2.0}
+RATE_BURSTS = {"bing": 1, "google": 1}
+
+# Number of pages requested concurrently (each from a different query or search engine)
+NUM_WORKERS = 8
+
+# Number of retries of a request that fails with a transient error (connection errors, 429 and 5xx)
+MAX_RETRIES = 3
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Number of urls per record of a compacted checkpoint
+URLS_PER_RECORD = 1000
+
 # Get absolute path of this file and force relative-to-file paths
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
-# The checkpoint file recording the search progress
+# The checkpoint file recording the search progress (an append-only journal of JSON lines)
 CHECKPOINT = os.path.join(FILE_DIR, "searcher.json")
 # The file where image_urls will be exported to
 IMAGE_URLS = os.path.join(FILE_DIR, "image_urls.csv")
 
+# Each worker thread keeps its own session, i.e. its own pool of connections per host
+thread_local = threading.local()
+
 
 def init_api(search_engines):
     """
@@ -44,39 +65,86 @@ def init_api(search_engines):
         os.environ["GOOGLE_CX"] = input("Please enter your Google Custom Search CX: ")
 
 
-def api_search(endpoint, headers, params):
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter: requests take a token each, and tokens
+    are refilled at `rate` tokens per second, up to `capacity` tokens (the burst size).
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def get_session():
+    """
+    Get the requests session of the current thread, whose connections are reused between requests.
+    """
+    if not hasattr(thread_local, "session"):
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def api_search(endpoint, headers, params, rate_limiter=None, retries=MAX_RETRIES):
     """
     Performs an API request to a search API (either Bing or Google in our case).
 
     Args:
-        search_engine: The name of the search engine to use.
+        endpoint: The endpoint of the API of the search engine.
         headers: The headers of the API request.
         params: The parameters of the API request.
-        ignore_error: Ignore request error and continue without prompting the user.
+        rate_limiter: The TokenBucket of the search engine, if any.
+        retries: Number of retries if the request fails with a transient error.
 
     Returns:
-        A tuple containing the response, as a dictionary, and its status code.
+        A tuple containing the response, as a dictionary (None in case of an error), and its status code.
     """
 
-    time.sleep(0.5)  # this ensures at most 2 requests per second
     result = None
     status_code = -1
 
-    try:
-        response = requests.get(endpoint, headers=headers, params=params)
-        status_code = response.status_code
-        response.raise_for_status()
-        result = response.json()
-    except requests.exceptions.HTTPError as e:
-        print("Bad request! ({})".format(status_code))
-        print(e)
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            response = get_session().get(endpoint, headers=headers, params=params, timeout=30)
+            status_code = response.status_code
+            response.raise_for_status()
+            return response.json(), status_code
+        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print("Bad request! ({})".format(status_code))
+            print(e)
+            if attempt == retries or (status_code != -1 and status_code not in RETRY_STATUS_CODES):
+                break
+            time.sleep(2 ** attempt * (1 + random.random()))  # exponential backoff
 
     return result, status_code
 
 
 ###########################
 class DataSearcher:
-    def __init__(self, queries=[], checkpoint="checkpoint", load_from_checkpoint=True):
+    def __init__(self, queries=[], checkpoint="checkpoint", load_from_checkpoint=True,
+                 endpoints=API_ENDPOINTS, rate_limits=RATE_LIMITS):
 
         # Sanity checks
         for query in queries: assert isinstance(query, str)
@@ -84,26 +152,42 @@ class DataSearcher:
 
         self.checkpoint = checkpoint
         self.queries = queries       # the search queries for building the dataset
-        self.query_index = 0         # the index of the current search query
         self.image_urls = []         # the url of the contents (images)
+        self.url_index = set()       # the set of `image_urls`, to avoid duplicates
         self.reset_search_indices()  # reset api-specific search index values
 
+        # The API endpoints (e.g. a local stub for testing) and the rate limiter of each search engine
+        self.endpoints = dict(endpoints)
+        self.rate_limiters = {engine: TokenBucket(rate, RATE_BURSTS.get(engine, 1))
+                              for engine, rate in rate_limits.items()}
+
+        self.lock = threading.Lock()       # guards the urls, the search indices and the journal
+        self.stopped = threading.Event()   # set to stop all searches (e.g. on interrupt)
+        self.journal = None                # the checkpoint file, opened for appending records
+
         # Load from checkpoint, if any
         if load_from_checkpoint:
             self.load()
 
     def reset_search_indices(self):
         """
-        Reset the indices that describe the search progress of the current query.
+        Reset the indices that describe the search progress of each query.
         """
-        self.bing_offset = 0   # offset value of the image search (for Bing)
-        self.google_start = 1  # offset value of the image search (for Google)
+        self.bing_offsets = {}   # offset value of the image search of each query (for Bing)
+        self.google_starts = {}  # offset value of the image search of each query (for Google)
+        self.done = {"bing": [], "google": []}  # the queries whose search is finished, per search engine
 
 
     ###########################
-    def search(self, search_engines=["bing"]):
+    def search(self, search_engines=["bing"], num_workers=NUM_WORKERS):
         """
         Search for images from all the queries using Bing's and Google's API.
+        The pages of each query are requested in order, but the queries of all
+        search engines are searched concurrently (within the rate limit of each engine).
+
+        Args:
+            search_engines: The search engines to be used.
+            num_workers: Number of pages requested concurrently.
         """
 
         # Check if given search engines are string and make them lowercase
@@ -113,21 +197,26 @@ class DataSearcher:
         # Initialize API if not done yet
         init_api(search_engines)
 
+        searches = {"bing": self.search_bing, "google": self.search_google}
+        self.stopped.clear()
+
+        # Start the journal of this search from a compacted checkpoint
+        self.save()
+
         # Try to search for images using the given search_engines
+        executor = ThreadPoolExecutor(max_workers=num_workers)
         try:
             start_time = time.time()  # track time
-            while self.query_index < len(self.queries):
-                # Get current query
-                query = self.queries[self.query_index]
-
-                # Search for images
-                if "bing" in search_engines: self.search_bing(query)
-                if "google" in search_engines: self.search_google(query)
-
-                # Finished search for this query
-                self.query_index += 1
-                self.reset_search_indices()
-            
+            futures = [executor.submit(searches[engine], query)
+                       for query in self.queries for engine in search_engines
+                       if query not in self.done[engine]]
+
+            # Wait with a timeout, so that the main thread can be interrupted
+            while wait(futures, timeout=0.5).not_done:
+                pass
+            for future in futures:
+                future.result()
+
             print()
             print("Total image urls found = {}.".format(len(self.image_urls)))
             print("Time elapsed = {:.3f} seconds.".format(time.time() - start_time))
@@ -137,15 +226,62 @@ class DataSearcher:
 
         except (KeyboardInterrupt, SystemExit):
             print("Interrupted.")
+            self.stopped.set()
+            executor.shutdown(wait=True)
             self.save()
 
         except Exception as e:
             # Interrupt all exceptions and keyboard interrupt to save progress
             print("Error!")
+            self.stopped.set()
+            executor.shutdown(wait=True)
             self.save()
             print("\nRaising error:")
             raise e
 
+        finally:
+            executor.shutdown(wait=True)
+
+
+    def add_page(self, search_engine, query, page_urls, next_index):
+        """
+        Add the urls of a page of results to the url index, skipping the urls already found,
+        and advance the search index of the query.
+
+        Args:
+            search_engine: The search engine of the page.
+            query: The query of the page.
+            page_urls: The urls of the page.
+            next_index: The search index of the next page of the query.
+
+        Returns:
+            The new urls of the page.
+        """
+
+        with self.lock:
+            new_image_urls = []
+            for image_url in page_urls:
+                if image_url not in self.url_index:
+                    self.url_index.add(image_url)
+                    new_image_urls.append(image_url)
+            self.image_urls += new_image_urls
+
+            if search_engine == "bing":
+                self.bing_offsets[query] = next_index
+            else:
+                self.google_starts[query] = next_index
+
+            # Checkpoint only the delta of the page
+            self.append_record({"urls": new_image_urls, "cursor": [search_engine, query, next_index]})
+
+        return new_image_urls
+
+
+    def finish_query(self, search_engine, query):
+        with self.lock:
+            self.done[search_engine].append(query)
+            self.append_record({"done": [search_engine, query]})
+
 
     def search_bing(self, query):
         """
@@ -155,49 +291,53 @@ class DataSearcher:
             query: query: The query of the search.
         """
 
-        old_image_urls = set(self.image_urls)  # to avoid duplicates
         totalEstimatedMatches = 1e6  # to ensure that offset is smaller first
+        bing_offset = self.bing_offsets.get(query, 0)
+        num_found = 0
 
         # Define headers and default params of bing image search api
         headers = {"Ocp-Apim-Subscription-Key": os.environ["BING_API_KEY"]}
         params = {
             "q": query,
-            "offset": self.bing_offset,
+            "offset": bing_offset,
             "imageType": "photo",
         }  # "size": "Medium", "imageContent": "Face" or "Portrait",
 
         # Continue the search until all results are exhausted
-        print("\nStarting Bing image search for query '%s'." % query)
-        while self.bing_offset < min(totalEstimatedMatches, MAX_RESULTS):
+        print("Starting Bing image search for query '%s'." % query)
+        while bing_offset < min(totalEstimatedMatches, MAX_RESULTS):
+            if self.stopped.is_set():
+                return
 
             # Search for images starting from the specified offset
-            print("Searching from offset %d ... " % self.bing_offset, end="")
-            params["offset"] = self.bing_offset
-            result, status_code = api_search(BING_API_ENDPOINT, headers, params)
+            params["offset"] = bing_offset
+            result, status_code = api_search(self.endpoints["bing"], headers, params, self.rate_limiters.get("bing"))
 
-            # Checking result of api search
+            # Checking result of api search (give up on the query for now, it is resumed on the next search)
             if result is None or "value" not in result:
-                print("Trying again...")
-                continue
-            print("Done.")
-
-            # Search for image urls and filter out the already saved urls
-            new_image_urls = [image["contentUrl"] for image in result["value"]
-                if image["contentUrl"] not in old_image_urls]
-            self.image_urls += new_image_urls
-            print("  Retrieved {} new image urls.".format(len(new_image_urls)))
+                print("Bing image search for query '{}' failed at offset {}.".format(query, bing_offset))
+                return
 
             # Update offset and estimated matches
             if "totalEstimatedMatches" in result:
                 totalEstimatedMatches = result["totalEstimatedMatches"]
             if "nextOffset" in result:
-                self.bing_offset = result["nextOffset"]
+                next_offset = result["nextOffset"]
             else:
-                self.bing_offset += len(result["value"])
+                next_offset = bing_offset + len(result["value"])
+
+            # Add the new image urls
+            new_image_urls = self.add_page("bing", query, [image["contentUrl"] for image in result["value"]], next_offset)
+            num_found += len(new_image_urls)
+            print("[bing] '{}' offset {}: retrieved {} new image urls.".format(query, bing_offset, len(new_image_urls)))
 
+            if len(result["value"]) == 0 or next_offset <= bing_offset:
+                break  # no more results
+            bing_offset = next_offset
+
+        self.finish_query("bing", query)
         print("Bing image search for query '{}' done.".format(query))
-        print("Retrieved {} new image urls in total.".format(
-            len(self.image_urls) - len(old_image_urls)))
+        print("Retrieved {} new image urls in total.".format(num_found))
 
 
     def search_google(self, query):
@@ -208,51 +348,101 @@ class DataSearcher:
             query: The query of the search.
         """
 
-        old_image_urls = set(self.image_urls)  # to avoid duplicates
+        google_start = self.google_starts.get(query, 1)
+        num_found = 0
 
-         # Define headers and default params of google custom search api
+        # Define headers and default params of google custom search api
         params = {
             "key": os.environ["GOOGLE_API_KEY"],
             "q": query,
             "cx": os.environ["GOOGLE_CX"],
             "searchType": "image",
-            "start": 1,
+            "start": google_start,
             "num": 10,
         }
 
         # Continue the search until all results are exhausted
-        print("\nStarting Google image search for query: '%s'." % query)
-        while self.google_start < min(100, MAX_RESULTS):
+        print("Starting Google image search for query: '%s'." % query)
+        while google_start < min(100, MAX_RESULTS):
+            if self.stopped.is_set():
+                return
 
             # Search for images starting from start index
-            print("Searching from start index %d ... " % self.google_start, end="")
-            params["start"] = self.google_start
-            result, status_code = api_search("google", {}, params)
+            params["start"] = google_start
+            result, status_code = api_search(self.endpoints["google"], {}, params, self.rate_limiters.get("google"))
 
-            # Check results of api search
+            # Check results of api search (give up on the query for now, it is resumed on the next search)
             if result is None:
-                print("Trying again...")
-                continue
-            print("Done")
+                print("Google image search for query '{}' failed at start index {}.".format(query, google_start))
+                return
 
-            # Search for image urls and filter out the already saved urls
-            new_image_urls = [image["link"] for image in result["items"]
-                if image["link"] not in old_image_urls]
-            self.image_urls += new_image_urls
-            print("  Retrieved {} new image urls.".format(len(new_image_urls)))
+            # Add the new image urls, and update start index
+            items = result.get("items", [])
+            new_image_urls = self.add_page("google", query, [image["link"] for image in items], google_start + params["num"])
+            num_found += len(new_image_urls)
+            print("[google] '{}' start index {}: retrieved {} new image urls.".format(query, google_start, len(new_image_urls)))
 
-            # Update start index
-            self.google_start += params["num"]
+            if len(items) == 0:
+                break  # no more results
+            google_start += params["num"]
+
+        self.finish_query("google", query)
+        print("Google image search for query '{}' done.".format(query))
+        print("Retrieved {} new image urls in total.".format(num_found))
 
-        print("Google image search done. ")
-        print("Retrieved {} new image urls in total.".format(
-            len(self.image_urls) - len(old_image_urls)))
 
-    
     ###########################
+    # The checkpoint is an append-only journal of JSON records (one per line), each of which may have:
+    #   "queries": the search queries,
+    #   "urls": new image urls,
+    #   "cursor": [search engine, query, search index of the next page of the query],
+    #   "done": [search engine, query] of a finished query.
+    # Every page appends one record (its new urls and cursor), and `save` compacts the journal
+    # (at the start and at the end of a search).
+
+    def append_record(self, record):
+        """
+        Append a record to the checkpoint (must hold the lock). Records are flushed
+        immediately, so a crash loses at most the pages in flight.
+        """
+        if self.journal is None:
+            self.journal = open(self.checkpoint, "a")
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+
+
+    def apply_record(self, record):
+        """
+        Apply a record of the checkpoint to `self`.
+        """
+
+        # Checkpoints of the sequential searcher were one json object
+        if "image_urls" in record:
+            self.from_json(record)
+            return
+
+        if "queries" in record:
+            self.queries = record["queries"]
+        if "urls" in record:
+            for image_url in record["urls"]:
+                if image_url not in self.url_index:
+                    self.url_index.add(image_url)
+                    self.image_urls.append(image_url)
+        if "cursor" in record:
+            search_engine, query, next_index = record["cursor"]
+            if search_engine == "bing":
+                self.bing_offsets[query] = next_index
+            else:
+                self.google_starts[query] = next_index
+        if "done" in record:
+            search_engine, query = record["done"]
+            if query not in self.done[search_engine]:
+                self.done[search_engine].append(query)
+
+
     def load(self, checkpoint=None):
         """
-        Loads the searcher from a json checkpoint file.
+        Loads the searcher from a checkpoint file (a journal, or a json file of an older version).
 
         Args:
             checkpoint: The name of the checkpoint file.
@@ -263,9 +453,13 @@ class DataSearcher:
         print("[*] Loading search progress from '{}'... ".format(checkpoint), end="")
         if os.path.isfile(checkpoint):
             with open(checkpoint, "r") as f:
-                dataset_metadata = json.load(f)
-                print("Loaded.")
-                self.from_json(dataset_metadata)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write of a crash
+                    self.apply_record(record)
+            print("Loaded.")
         else:
             print("Couldn't find file.")
             if "n" == input("Type anything to start a new search or 'n' to exit: "):
@@ -274,7 +468,8 @@ class DataSearcher:
 
     def save(self, checkpoint=None):
         """
-        Saves the searcher to a json checkpoint file.
+        Saves the searcher to a checkpoint file, compacting its records into as few records
+        as possible. The compacted checkpoint replaces the old one atomically.
 
         Args:
             checkpoint: The name of the checkpoint file.
@@ -283,9 +478,26 @@ class DataSearcher:
         if checkpoint is None: checkpoint = self.checkpoint
 
         print("[*] Saving search progress to '{}'... ".format(checkpoint), end="")
-        with open(checkpoint, "w") as f:
+        with self.lock:
             search_json = self.to_json()
-            json.dump(search_json, f)
+
+            records = [{"queries": search_json["queries"]}]
+            records += [{"cursor": ["bing", query, offset]} for query, offset in search_json["bing_offsets"].items()]
+            records += [{"cursor": ["google", query, start]} for query, start in search_json["google_starts"].items()]
+            records += [{"done": [engine, query]} for engine, queries in search_json["done"].items() for query in queries]
+            image_urls = search_json["image_urls"]
+            records += [{"urls": image_urls[i:i + URLS_PER_RECORD]} for i in range(0, len(image_urls), URLS_PER_RECORD)]
+
+            with open(checkpoint + ".tmp", "w") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            os.replace(checkpoint + ".tmp", checkpoint)
+            self.checkpoint = checkpoint
             print("Saved.")
 
 
@@ -297,11 +509,24 @@ class DataSearcher:
             search_json: A dict holding the progress data of the given searcher.
         """
 
-        self.query_index  = search_json["query_index"]
-        self.queries      = search_json["queries"]
-        self.bing_offset  = search_json["bing_offset"]
-        self.google_start = search_json["google_start"]
-        self.image_urls   = search_json["image_urls"]
+        self.queries    = search_json["queries"]
+        self.image_urls = search_json["image_urls"]
+        self.url_index  = set(self.image_urls)
+
+        # Checkpoints of the sequential searcher recorded the search indices of the current query only
+        if "query_index" in search_json:
+            self.reset_search_indices()
+            query_index = search_json["query_index"]
+            for search_engine in SEARCH_ENGINES:
+                self.done[search_engine] = self.queries[:query_index]
+            if query_index < len(self.queries):
+                self.bing_offsets[self.queries[query_index]] = search_json["bing_offset"]
+                self.google_starts[self.queries[query_index]] = search_json["google_start"]
+            return
+
+        self.bing_offsets  = search_json["bing_offsets"]
+        self.google_starts = search_json["google_starts"]
+        self.done          = search_json["done"]
 
 
     def to_json(self):
@@ -313,11 +538,11 @@ class DataSearcher:
         """
 
         search_json = {}
-        search_json["query_index"]  = self.query_index
-        search_json["queries"]      = self.queries
-        search_json["bing_offset"]  = self.bing_offset
-        search_json["google_start"] = self.google_start
-        search_json["image_urls"]   = self.image_urls
+        search_json["queries"]       = self.queries
+        search_json["bing_offsets"]  = dict(self.bing_offsets)
+        search_json["google_starts"] = dict(self.google_starts)
+        search_json["done"]          = {engine: list(queries) for engine, queries in self.done.items()}
+        search_json["image_urls"]    = list(self.image_urls)
 
         return search_json
 
@@ -329,7 +554,7 @@ class DataSearcher:
         Args:
             fname: The name of the file where the urls will be written.
         """
-        
+
         with open(fname, "w") as f:
             f.writelines(image_url + "\n" for image_url in self.image_urls)
 
@@ -340,17 +565,18 @@ def main(args):
     searcher_params = {
         "queries": args.queries,
         "checkpoint": args.checkpoint,
+        "rate_limits": {engine: args.rate for engine in SEARCH_ENGINES} if args.rate else RATE_LIMITS,
     }
 
     searcher = DataSearcher(**searcher_params)
-    searcher.search(args.search_engines)
+    searcher.search(args.search_engines, args.workers)
     searcher.export_image_urls(args.out)
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Search images using Bing and Google.")
-    
+
     parser.add_argument("--search_engines", nargs="+", type=str, default=SEARCH_ENGINES,
         help="the search engines to be used.",
         choices=SEARCH_ENGINES)
@@ -360,8 +586,11 @@ if __name__ == '__main__':
         help="name of checkpoint file.")
     parser.add_argument("-o", "--out", type=str, default=IMAGE_URLS,
         help="the output file where the urls of the images will be saved.")
-    
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+        help="number of pages requested concurrently (from different queries or search engines).")
+    parser.add_argument("--rate", type=float, default=None,
+        help="max requests per second to each search engine (defaults to the quota of each engine).")
+
     args = parser.parse_args()
 
     main(args)
-
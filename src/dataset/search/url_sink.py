@@ -0,0 +1,96 @@
+import os
+import hashlib
+
+
+# Number of urls buffered before they are appended to the csv file
+BATCH_SIZE = 1000
+
+
+def url_key(url):
+    """
+    A short (8-byte) digest of a url, so the set of seen urls takes a fraction
+    of the memory of the urls themselves.
+    """
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+
+
+class UrlSink:
+    """
+    Write urls to a csv file (one url per line), skipping the urls already written, and
+    appending them in batches. Only the digests of the urls are kept in memory.
+
+    Usage:
+        with UrlSink("image_urls.csv") as sink:
+            sink.add(urls)
+    """
+
+    def __init__(self, path, append=False, batch_size=BATCH_SIZE):
+        """
+        Args:
+            path: The path of the csv file.
+            append: Append to the file (skipping the urls it has) instead of overwriting it.
+            batch_size: Number of urls buffered before they are written.
+        """
+
+        self.path = path
+        self.batch_size = batch_size
+        self.seen = set()       # the digests of the urls written (or buffered)
+        self.batch = []         # the urls not written yet
+        self.num_urls = 0       # number of new urls
+        self.num_duplicates = 0
+
+        if append and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    url = line.strip()
+                    if url:
+                        self.seen.add(url_key(url))
+
+        self.file = open(path, "a" if append else "w")
+
+
+    def add(self, urls):
+        """
+        Add urls to the sink, skipping the urls already seen.
+
+        Args:
+            urls: An iterable of urls.
+
+        Returns:
+            The number of new urls.
+        """
+
+        num_urls = 0
+        for url in urls:
+            key = url_key(url)
+            if key in self.seen:
+                self.num_duplicates += 1
+                continue
+            self.seen.add(key)
+            self.batch.append(url)
+            num_urls += 1
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+        self.num_urls += num_urls
+        return num_urls
+
+
+    def flush(self):
+        self.file.writelines(url + "\n" for url in self.batch)
+        self.file.flush()
+        self.batch = []
+
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,334 @@
+import os
+import io
+import json
+import random
+import tarfile
+import argparse
+import numpy as np
+import torch
+import torch.utils.data as data_utils
+import torch.distributed as dist
+from PIL import Image
+
+from .landmarks import LandmarksStore, LANDMARKS_INDEX, LANDMARKS_SIZE
+
+
+# Get absolute path of this file and force relative-to-file paths
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATASET_DIR = os.path.join(FILE_DIR, "data", "instagram")
+SHARDS_DIR = os.path.join(FILE_DIR, "data", "shards")
+
+# The domains (sub-directories) of MakeupDataset2 that are sharded
+DOMAINS = ("nomakeup", "makeup")
+
+# The names of the shards of a domain and of the index of all shards
+SHARD_NAME_FORMAT = lambda domain, index: "{}-{:05d}.tar".format(domain, index)
+SHARDS_INDEX = "shards.json"
+
+# Landmarks are stored in shards next to their image, as raw normalized float32 coordinates
+LANDMARKS_EXT = ".landmarks"
+
+
+def write_shards(dataset_dir, shards_dir, shard_size=1000):
+    """
+    Write the `nomakeup` and `makeup` images of a MakeupDataset2 directory into
+    sequential tar shards of `shard_size` images each, to be streamed by MakeupShardDataset.
+    The landmarks of the images are written as well, if the dataset has a landmarks store.
+
+    Args:
+        dataset_dir: The directory of the dataset.
+        shards_dir: The directory where the shards will be written.
+        shard_size: Number of images per shard.
+    """
+
+    if not os.path.isdir(shards_dir): os.mkdir(shards_dir)
+
+    landmarks_store = None
+    if os.path.isfile(os.path.join(dataset_dir, LANDMARKS_INDEX)):
+        landmarks_store = LandmarksStore(dataset_dir)
+
+    index = {}
+    for domain in DOMAINS:
+        domain_dir = os.path.join(dataset_dir, domain)
+        file_names = sorted(f for f in os.listdir(domain_dir) if f[0] != "."
+                            and os.path.isfile(os.path.join(domain_dir, f)))
+
+        index[domain] = []
+        for shard_index, start in enumerate(range(0, len(file_names), shard_size)):
+            shard_name = SHARD_NAME_FORMAT(domain, shard_index)
+            shard_files = file_names[start:start + shard_size]
+            print("Writing shard {} ({} images)... ".format(shard_name, len(shard_files)))
+
+            with tarfile.open(os.path.join(shards_dir, shard_name), "w") as shard:
+                for file_name in shard_files:
+                    image_path = os.path.join(domain_dir, file_name)
+                    shard.add(image_path, arcname=file_name)
+
+                    if landmarks_store is not None and image_path in landmarks_store:
+                        landmarks = landmarks_store.normalized(image_path).tobytes()
+                        info = tarfile.TarInfo(file_name + LANDMARKS_EXT)
+                        info.size = len(landmarks)
+                        shard.addfile(info, io.BytesIO(landmarks))
+
+            index[domain].append([shard_name, len(shard_files)])
+
+    with open(os.path.join(shards_dir, SHARDS_INDEX), "w") as f:
+        json.dump(index, f)
+
+
+def shuffled(iterable, buffer_size, rng):
+    """
+    Shuffle a stream approximately, by yielding random items from a buffer of `buffer_size` items.
+
+    Args:
+        iterable: The stream of items.
+        buffer_size: The size of the shuffle buffer (1 or less means no shuffling).
+        rng: The random number generator.
+    """
+
+    if buffer_size <= 1:
+        yield from iterable
+        return
+
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class MakeupShardDataset(data_utils.IterableDataset):
+    """
+    A streaming, unpaired version of MakeupDataset2 that reads sequential tar shards
+    (see `write_shards`). Shards are split between the workers of the data loader and
+    between the processes of `torch.distributed`, if initialized, and their images
+    are shuffled in memory with a shuffle buffer.
+    """
+
+    def __init__(self, shards_dir,
+                 transform=None,
+                 with_landmarks=False,
+                 reverse=False,
+                 image_size=None,
+                 shuffle_buffer=1000,
+                 seed=0):
+        """
+        Initializes MakeupShardDataset.
+
+        Args:
+            shards_dir: The directory of the shards.
+            transform: The transform used on the data.
+            with_landmarks: A flag indicating whether landmarks (stored in the shards) should be used or not.
+            reverse: Reverses sample if True (before = with makeup, after = no makeup).
+            image_size: Resize images to (image_size x image_size) when loaded, if given.
+            shuffle_buffer: Size of the shuffle buffer of each domain (0 to disable shuffling).
+            seed: Seed of the shuffling (combined with the epoch, the rank, and the worker).
+        """
+
+        index_path = os.path.join(shards_dir, SHARDS_INDEX)
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError(f"Shards index '{index_path}' does not exist.")
+
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        self.shards_dir = shards_dir
+        self.transform = transform
+        self.with_landmarks = with_landmarks
+        self.reverse = reverse
+        self.image_size = image_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0  # each worker counts its own epochs, since persistent workers keep their copy
+
+        self.shards_before = [name for name, _ in index["nomakeup"]]
+        self.shards_after = [name for name, _ in index["makeup"]]
+        self.num_before = sum(count for _, count in index["nomakeup"])
+        self.num_after = sum(count for _, count in index["makeup"])
+
+
+    def __len__(self):
+        """Returns the (approximate, if split between processes) length of the dataset."""
+        return max(self.num_before, self.num_after) // self.world_size()
+
+
+    def world_size(self):
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+    def split(self):
+        """
+        Get the split of the shards of the current process and worker.
+
+        Returns:
+            The index of the current split and the number of splits.
+        """
+
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        worker_info = data_utils.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        return rank * num_workers + worker_id, self.world_size() * num_workers
+
+
+    def split_shards(self, shards):
+        """
+        Get the shards of the current process and worker, out of `shards`.
+        """
+
+        split_index, num_splits = self.split()
+        return shards[split_index::num_splits]
+
+
+    def read_shards(self, shards, rng):
+        """
+        A generator that yields (image bytes, landmarks bytes or None) pairs
+        from `shards`, read sequentially in a random order.
+        """
+
+        shards = list(shards)
+        rng.shuffle(shards)
+
+        for shard_name in shards:
+            image_bytes = None
+            with tarfile.open(os.path.join(self.shards_dir, shard_name), "r|") as shard:
+                for member in shard:
+                    if not member.isfile():
+                        continue
+                    data = shard.extractfile(member).read()
+                    if member.name.endswith(LANDMARKS_EXT):
+                        yield image_bytes, data
+                        image_bytes = None
+                        continue
+                    if image_bytes is not None:
+                        yield image_bytes, None
+                    image_bytes = data
+            if image_bytes is not None:
+                yield image_bytes, None
+
+
+    def stream(self, shards, rng, repeat=False):
+        """
+        A generator that yields shuffled (image bytes, landmarks bytes) pairs
+        from `shards`, repeating the shards forever if `repeat`.
+        """
+        while True:
+            yield from shuffled(self.read_shards(shards, rng), self.shuffle_buffer, rng)
+            if not repeat:
+                break
+
+
+    def __iter__(self):
+
+        split_index, num_splits = self.split()
+        rng = random.Random("{}-{}-{}".format(self.seed, self.epoch, split_index))
+        self.epoch += 1
+
+        # Cover the larger domain and repeat the smaller one
+        before_is_larger = self.num_before >= self.num_after
+        shards_larger, shards_smaller = ((self.shards_before, self.shards_after) if before_is_larger
+                                         else (self.shards_after, self.shards_before))
+
+        # The shards of the larger domain are split between the workers (some of which may get none
+        # if there are too few shards), while a worker whose split of the smaller domain is empty
+        # repeats the whole smaller domain (shuffled by its own rng), so no shard of the larger domain is dropped
+        if len(shards_larger) < num_splits and split_index == 0:
+            print(f"Warning: {len(shards_larger)} shards are too few for {num_splits} workers, some workers will be idle.")
+        split_larger = self.split_shards(shards_larger)
+        if len(split_larger) == 0:
+            return
+        split_smaller = self.split_shards(shards_smaller) or shards_smaller
+        if len(split_smaller) == 0:
+            return
+
+        stream_larger = self.stream(split_larger, rng)
+        stream_smaller = self.stream(split_smaller, rng, repeat=True)
+        if before_is_larger:
+            stream_before, stream_after = stream_larger, stream_smaller
+        else:
+            stream_before, stream_after = stream_smaller, stream_larger
+
+        for before, after in zip(stream_before, stream_after):
+            yield self.make_sample(before, after)
+
+
+    def load_image(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        if self.image_size is not None:
+            image = image.resize((self.image_size, self.image_size), Image.BILINEAR)
+        return image
+
+
+    def load_landmarks(self, landmarks_bytes, image):
+        """
+        Scale the normalized landmarks stored in a shard to the image (a tensor).
+        Returns zeros if the image has no landmarks, as MakeupDataset does.
+        """
+        if landmarks_bytes is None:
+            return torch.zeros(LANDMARKS_SIZE, dtype=torch.int)
+
+        height, width = image.shape[-2:]
+        landmarks = np.frombuffer(landmarks_bytes, dtype=np.float32).reshape(LANDMARKS_SIZE)
+        landmarks = landmarks * np.array([width, height], dtype=np.float32)
+        return torch.from_numpy(landmarks.round().astype(np.int32))
+
+
+    def make_sample(self, before, after):
+        """
+        Make a sample, as in MakeupDataset, out of the (image bytes, landmarks bytes) pairs of
+        the before and after images.
+        """
+
+        sample = {
+            "before": self.load_image(before[0]),
+            "after": self.load_image(after[0]),
+        }
+
+        if self.transform is not None:
+            sample = self.transform(sample)
+
+        if self.with_landmarks:
+            sample["landmarks"] = {
+                "before": self.load_landmarks(before[1], sample["before"]),
+                "after": self.load_landmarks(after[1], sample["after"]),
+            }
+
+        # Reverse direction of sample
+        if self.reverse:
+            sample["before"], sample["after"] = sample["after"], sample["before"]
+            if "landmarks" in sample:
+                landmarks = sample["landmarks"]
+                landmarks["before"], landmarks["after"] = landmarks["after"], landmarks["before"]
+
+        return sample
+
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.shards_dir)
+
+
+def main(args):
+    write_shards(args.dataset_dir, args.shards_dir, args.shard_size)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Write the images of MakeupDataset2 into tar shards.")
+
+    parser.add_argument("--dataset_dir", type=str, default=DATASET_DIR,
+        help="directory of the dataset containing the 'makeup' and 'nomakeup' directories.")
+    parser.add_argument("--shards_dir", type=str, default=SHARDS_DIR,
+        help="directory where the shards will be written.")
+    parser.add_argument("--shard_size", type=int, default=1000,
+        help="number of images per shard.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,3 +1,6 @@
+import math
+import torch
+import torch.nn.functional as F
 
 
 class MakeupSampleTransform:
@@ -29,3 +32,106 @@ class MakeupSampleTransform:
 
         return sample
 
+
+# The index of each landmark's mirror image (e.g. left eye <-> right eye) in the
+# 72 landmarks of face_recognition, used to keep the landmarks' order when flipping
+FLIP_LANDMARKS_PERMUTATION = [
+    16, 15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0,  # chin
+    26, 25, 24, 23, 22, 21, 20, 19, 18, 17,  # left and right eyebrows
+    27, 28, 29, 30, 35, 34, 33, 32, 31,  # nose bridge and nose tip
+    45, 44, 43, 42, 47, 46, 39, 38, 37, 36, 41, 40,  # left and right eyes
+    54, 53, 52, 51, 50, 49, 48, 59, 58, 57, 56, 55,  # top lip
+    66, 65, 64, 63, 62, 61, 60, 71, 70, 69, 68, 67,  # bottom lip
+]
+
+
+class MakeupBatchTransform:
+    """
+    Random rotation and horizontal flip of collated batches of MakeupDataset samples.
+    Each batch of images is transformed with one `affine_grid`/`grid_sample` call,
+    and the landmarks of the sample (if any) are transformed with the same matrices.
+    """
+
+    def __init__(self, degrees=(-3, 3), flip_probability=0.5, fill=-1.0):
+        """
+        Initializes the transform.
+
+        Args:
+            degrees: Range of the degrees of the random rotations.
+            flip_probability: Probability of flipping an image horizontally.
+            fill: Value of the area outside the transformed images (-1 is black after normalization).
+        """
+        self.degrees = degrees
+        self.flip_probability = flip_probability
+        self.fill = fill
+
+    def random_matrices(self, batch_size, height, width, device):
+        """
+        Samples random rotation and flip matrices, in the normalized coordinates of
+        `affine_grid` (i.e. they map output coordinates to input coordinates).
+
+        Returns:
+            The matrices as a [batch_size, 2, 2] tensor and the flip flags as a [batch_size] tensor.
+        """
+
+        angles = torch.empty(batch_size, device=device).uniform_(*self.degrees) * math.pi / 180
+        flipped = torch.rand(batch_size, device=device) < self.flip_probability
+
+        # Rotation in pixel space, scaled to the normalized coordinates of a (width x height) image
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        aspect = height / width
+        matrices = torch.stack([
+            torch.stack([cos, -sin * aspect], dim=1),
+            torch.stack([sin / aspect, cos], dim=1),
+        ], dim=1)
+
+        # Flip the x-axis of the output before rotating
+        matrices[:, :, 0] *= 1 - 2 * flipped.to(matrices).unsqueeze(1)
+
+        return matrices, flipped
+
+    def transform_images(self, images, matrices):
+        theta = torch.cat([matrices, torch.zeros_like(matrices[:, :, :1])], dim=2)
+        grid = F.affine_grid(theta, images.size(), align_corners=False)
+        return F.grid_sample(images - self.fill, grid, align_corners=False) + self.fill
+
+    def transform_landmarks(self, landmarks, matrices, flipped, height, width):
+
+        # Landmarks are in pixels, which are mapped to the normalized coordinates of `affine_grid`
+        size = torch.tensor([width, height]).to(matrices)
+        points = (2 * landmarks.to(matrices) + 1) / size - 1
+
+        # Images are sampled with the matrices, so their inverse maps the landmarks
+        points = points @ torch.inverse(matrices).transpose(1, 2)
+        points = ((points + 1) * size - 1) / 2
+
+        # Keep the order of mirrored landmarks, and zeros for missing landmarks
+        permutation = torch.tensor(FLIP_LANDMARKS_PERMUTATION, device=points.device)
+        points[flipped] = points[flipped][:, permutation]
+        missing = (landmarks == 0).all(dim=2).all(dim=1)
+        points[missing] = 0
+
+        return points.round().to(landmarks.dtype)
+
+    def __call__(self, sample):
+        """
+        Transforms the given batch of samples.
+
+        Args:
+            sample: A collated batch of samples from MakeupDataset to be transformed.
+
+        Returns:
+            The transformed batch of samples.
+        """
+
+        for which in ("before", "after"):
+            images = sample[which]
+            batch_size, _, height, width = images.size()
+            matrices, flipped = self.random_matrices(batch_size, height, width, images.device)
+
+            sample[which] = self.transform_images(images, matrices)
+            if "landmarks" in sample:
+                sample["landmarks"][which] = self.transform_landmarks(
+                    sample["landmarks"][which], matrices, flipped, height, width)
+
+        return sample
@@ -1,4 +1,5 @@
 
+import gc
 import os
 import yaml
 import argparse
@@ -8,7 +9,8 @@ import torch
 import torchvision.transforms as transforms
 
 from dataset.dataset import MakeupDataset, MakeupDataset2
-from dataset.transforms import MakeupSampleTransform
+from dataset.shards import MakeupShardDataset
+from dataset.transforms import MakeupSampleTransform, MakeupBatchTransform
 
 from models.cyclegan import MaskCycleGAN
 from models.pairedcyclegan import PairedCycleGAN
@@ -58,6 +60,20 @@ def parse_args():
     ### Dataset Args ###
     parser.add_argument("--dataset-dir", type=str, default=DATASET_DIR,
         help="directory of the makeup dataset.")
+    parser.add_argument("--shards-dir", type=str,
+        help="stream the dataset from the tar shards written by 'dataset/shards.py' in this directory.")
+    parser.add_argument("--packed", action="store_true",
+        help="read images pre-decoded by 'dataset/packed.py' at --image-size.")
+    parser.add_argument("--cache-bytes", type=nonnegative(int), default=0,
+        help="budget in bytes of the cache of decoded images shared by the workers (0 to disable).")
+    parser.add_argument("--pyramid", action="store_true",
+        help="decode images from their smallest stored pyramid level at or above --image-size.")
+    parser.add_argument("--fast-decode", action="store_true",
+        help="decode JPEGs at a reduced scale still at or above --image-size.")
+    parser.add_argument("--use-manifest", action="store_true",
+        help="list the images from the dataset's manifest (see 'dataset/manifest.py').")
+    parser.add_argument("--min-image-side", type=nonnegative(int), default=0,
+        help="use only images whose smaller side is at least this long (requires --use-manifest).")
 
     ### Model Args ###
     parser.add_argument("--num-latents", type=positive(int), default=128,
@@ -86,6 +102,10 @@ def parse_args():
         help="number of workers that will be loading the dataset.")
     parser.add_argument("--batch-size", type=positive(int), default=4,
         help="size of the batch sample from the dataset.")
+    parser.add_argument("--prefetch-factor", type=positive(int), default=2,
+        help="number of batches loaded in advance by each worker.")
+    parser.add_argument("--prefetch-batches", type=nonnegative(int), default=2,
+        help="number of batches prepared in advance by a background thread of the trainer.")
 
     parser.add_argument("--D-optimizer", type=str.lower, default="sgd",
         help="the name of the optimizer used for training (SGD, Adam, RMSProp)",
@@ -166,6 +186,13 @@ def get_dataset_args(args):
     """
     dataset_args = {
         "dataset_dir": args.dataset_dir,
+        "shards_dir": args.shards_dir,
+        "packed": args.packed,
+        "cache_bytes": args.cache_bytes,
+        "pyramid": args.pyramid,
+        "fast_decode": args.fast_decode,
+        "use_manifest": args.use_manifest,
+        "filters": {"min_side": args.min_image_side} if args.min_image_side > 0 else {},
     }
 
     return dataset_args
@@ -201,6 +228,8 @@ def get_trainer_args(args):
         "num_gpu": args.num_gpu,
         "num_workers": args.num_workers,
         "batch_size": args.batch_size,
+        "prefetch_factor": args.prefetch_factor,
+        "prefetch_batches": args.prefetch_batches,
 
         "D_optim_config": {
             "optim_choice": args.D_optimizer,
@@ -260,14 +289,12 @@ def get_training_args(args):
     return dataset_args, model_args, trainer_args
 
 
-def make_transform(image_size):
+def make_transform():
     """
     Make data transform and return it.
+    Note that images are already resized by the dataset, and augmented in batches.
     """
     transform_sequence = [
-        transforms.Resize((image_size, image_size)),
-        transforms.RandomAffine(degrees=(-3, 3)),
-        transforms.RandomHorizontalFlip(),
         transforms.ToTensor(),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
     ]
@@ -277,6 +304,37 @@ def make_transform(image_size):
     return transform
 
 
+def make_batch_transform():
+    """
+    Make the augmentation of collated batches (and their landmarks) and return it.
+    """
+    return MakeupBatchTransform(degrees=(-3, 3), flip_probability=0.5)
+
+
+def make_dataset(dataset_args, **kwargs):
+    """
+    Make the makeup dataset and return it. It is streamed from tar shards if
+    `shards_dir` is given in `dataset_args`, otherwise it is read from `dataset_dir`.
+    """
+    dataset_args = dict(dataset_args)
+    shards_dir = dataset_args.pop("shards_dir", None)
+
+    if shards_dir is not None:
+        return MakeupShardDataset(shards_dir, **kwargs)
+
+    return MakeupDataset2(**dataset_args, **kwargs)
+
+
+def make_sampler(dataset, seed):
+    """
+    Make the sampler of the dataset and return it (None for streaming datasets).
+    """
+    if isinstance(dataset, MakeupShardDataset):
+        return None
+
+    return dataset.get_sampler(seed=seed)
+
+
 def main(args):
     """
     Trains the MakeupNet on MakeupDataset using MakeupNetTrainer.
@@ -291,24 +349,40 @@ def main(args):
     dataset_args, model_args, trainer_args = get_training_args(args)
 
     # Define data transformation and weights initializer
-    transform = make_transform(model_args["image_size"])
+    transform = make_transform()
+    batch_transform = make_batch_transform()
     weights_init = create_weights_init()
 
     # Train makeup remover using CycleGAN
-    makeup_gan_dataset = MakeupDataset2(**dataset_args, transform=transform)
+    makeup_gan_dataset = make_dataset(dataset_args, transform=transform,
+                                      image_size=model_args["image_size"])
     makeup_gan = MaskCycleGAN(**model_args)
     subtrainer = CycleGANTrainer(makeup_gan, makeup_gan_dataset,
                                  load_model_path=args.pretrained_model_path,
+                                 batch_transform=batch_transform,
+                                 sampler=make_sampler(makeup_gan_dataset, args.random_seed),
                                  name="makeup_gan", **trainer_args)
     subtrainer.run(num_epochs=args.pretrain_epochs, save_results=args.save_results)
+    if getattr(makeup_gan_dataset, "image_cache", None) is not None:
+        print(f"Image cache: {makeup_gan_dataset.image_cache}")
+
+    # Free the image cache of the first dataset before the second allocates its own,
+    # so that `cache_bytes` bounds the total shared memory of the caches
+    del subtrainer, makeup_gan_dataset
+    gc.collect()
 
     # Train PairedCycleGAN, and assign to it the pre-trained makeup remover
-    makeup_pcgan_dataset = MakeupDataset2(**dataset_args, transform=transform, with_landmarks=True)
+    makeup_pcgan_dataset = make_dataset(dataset_args, transform=transform, with_landmarks=True,
+                                        image_size=model_args["image_size"])
     makeup_pcgan = PairedCycleGAN(**model_args, custom_remover=makeup_gan.remover)
     trainer = PairedCycleGANTrainer(makeup_pcgan, makeup_pcgan_dataset,
                                     load_model_path=args.model_path,
+                                    batch_transform=batch_transform,
+                                    sampler=make_sampler(makeup_pcgan_dataset, args.random_seed),
                                     name="makeup_pcgan", **trainer_args)
     trainer.run(num_epochs=args.num_epochs, save_results=args.save_results)
+    if getattr(makeup_pcgan_dataset, "image_cache", None) is not None:
+        print(f"Image cache: {makeup_pcgan_dataset.image_cache}")
 
 
 if __name__ == "__main__":
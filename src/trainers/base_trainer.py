@@ -1,5 +1,8 @@
 
 import os
+import time
+import random
+import itertools
 import datetime
 import torch
 import torch.utils.tensorboard as tensorboard
@@ -7,6 +10,7 @@ import torch.utils.tensorboard as tensorboard
 from pprint import pformat
 from collections import defaultdict
 from .utils.report_utils import plot_lines
+from .utils.prefetch_utils import BackgroundPrefetcher
 
 
 class BaseTrainer:
@@ -19,8 +23,12 @@ class BaseTrainer:
         num_gpu=1,
         num_workers=0,
         batch_size=4,
+        prefetch_factor=2,
+        prefetch_batches=2,
         report_interval=10,
         save_interval=100000,
+        batch_transform=None,
+        sampler=None,
         use_tensorboard=False,  # XXX: not implemented yet
         description="no description given",
         **kwargs):
@@ -36,8 +44,15 @@ class BaseTrainer:
             num_gpu: Number of GPUs to use for training.
             num_workers: Number of workers sampling from the dataset.
             batch_size: Size of the batch. Must be > num_gpu.
+            prefetch_factor: Number of batches loaded in advance by each worker.
+            prefetch_batches: Number of batches prepared in advance by a background thread (0 to disable).
             report_interval: Report stats every `report_interval` iters.
             save_interval: Save model every `save_interval` iters.
+            batch_transform: A transform applied on each collated batch (e.g. batched augmentation).
+            sampler: Sampler of the dataset's indices, used instead of shuffling the dataset.
+                     Its `set_epoch` method, if any, is called at the start of every epoch.
+                     Defaults to `dataset.get_sampler()` if the dataset has one (e.g. to pair
+                     the unpaired images of MakeupDataset differently every epoch).
             description: Description of the experiment the trainer is running.
         """
 
@@ -51,9 +66,15 @@ class BaseTrainer:
         self.num_gpu = num_gpu
         self.num_workers = num_workers
         self.batch_size = batch_size
+        self.prefetch_factor = prefetch_factor
+        self.prefetch_batches = prefetch_batches
 
         self.report_interval = report_interval
         self.save_interval = save_interval
+        self.batch_transform = batch_transform
+        self.sampler = sampler
+        if self.sampler is None and hasattr(dataset, "get_sampler"):
+            self.sampler = dataset.get_sampler()
         self.description = description
         self.save_results = False
 
@@ -62,10 +83,14 @@ class BaseTrainer:
         self.iters = 1  # current iteration (i.e. # of batches processed so far)
         self.batch = 1  # current batch
         self.epoch = 1  # current epoch
-        self.num_batches = 1 + len(self.dataset) // self.batch_size  # num of batches per epoch
+        num_samples = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        self.num_batches = 1 + num_samples // self.batch_size  # num of batches per epoch
         self.num_epochs = 0  # number of epochs to run
 
+        self._data_loader = None  # long-lived data loader (its workers persist across epochs)
         self._dataset_sampler = iter(())  # generates samples from the dataset
+        self.data_wait_time = 0.0  # total seconds spent waiting for samples
+        self._iter_data_wait_time = 0.0  # seconds spent waiting for samples in current iteration
         self._data = defaultdict(list)  # contains data of experiment
 
         self.writer = None
@@ -156,37 +181,60 @@ class BaseTrainer:
         except StopIteration:
             print("Finished training.")
 
+        finally:
+            self.close_dataset_sampler()
+
 
     def init_dataset_sampler(self):
         """
         Initializes the sampler (or iterator) of the dataset.
-
-        Args:
-            num_epochs: Number of epochs.
+        The data loader is created once, and its workers persist across epochs.
         """
+        is_iterable = isinstance(self.dataset, torch.utils.data.IterableDataset)
         loader_config = {
             "batch_size": self.batch_size,
-            "shuffle": True,
+            "shuffle": self.sampler is None and not is_iterable,  # iterable datasets shuffle themselves
+            "sampler": self.sampler,
             "num_workers": self.num_workers,
         }
-        self._dataset_sampler = iter(self.sample_loader(loader_config))
+        if self.num_workers > 0:
+            loader_config["persistent_workers"] = True
+            loader_config["prefetch_factor"] = self.prefetch_factor
+
+        self._data_loader = torch.utils.data.DataLoader(self.dataset, **loader_config)
+        self._dataset_sampler = self.sample_loader(self._data_loader)
 
+        # Prepare the next batches in the background, even across epochs
+        if self.prefetch_batches > 0:
+            self._dataset_sampler = BackgroundPrefetcher(self._dataset_sampler, self.prefetch_batches)
 
-    def sample_loader(self, loader_config):
+
+    def close_dataset_sampler(self):
+        """
+        Stops the sampler of the dataset and shuts down the workers of the data loader.
+        """
+        if isinstance(self._dataset_sampler, BackgroundPrefetcher):
+            self._dataset_sampler.close()
+        self._dataset_sampler = iter(())
+        self._data_loader = None
+
+
+    def sample_loader(self, data_loader):
         """
         A generator that yields samples from the dataset, exhausting it `num_epochs` times.
+        Samples are yielded with their epoch and batch, since they may be prefetched.
 
         Args:
-            num_epochs: Number of epochs.
-            loader_config: Configuration for pytorch's data loader.
+            data_loader: Pytorch's data loader of the dataset.
         """
 
-        for self.epoch in range(self.epoch, self.num_epochs + 1):
-            data_loader = torch.utils.data.DataLoader(self.dataset, **loader_config)
-            for self.batch, sample in enumerate(data_loader, 1):
-                yield sample
-
-        self.epoch += 1
+        for epoch in range(self.epoch, self.num_epochs + 1):
+            if hasattr(self.sampler, "set_epoch"):
+                self.sampler.set_epoch(epoch)
+            for batch, sample in enumerate(data_loader, 1):
+                if self.batch_transform is not None:
+                    sample = self.batch_transform(sample)
+                yield epoch, batch, sample
 
 
     def sample_dataset(self):
@@ -196,7 +244,40 @@ class BaseTrainer:
         Returns:
             A sample from the dataset.
         """
-        return next(self._dataset_sampler)
+        start_time = time.perf_counter()
+        try:
+            self.epoch, self.batch, sample = next(self._dataset_sampler)
+        except StopIteration:
+            self.epoch = max(self.epoch, self.num_epochs) + 1
+            raise
+        finally:
+            wait_time = time.perf_counter() - start_time
+            self.data_wait_time += wait_time
+            self._iter_data_wait_time += wait_time
+
+        return sample
+
+
+    def get_fixed_images(self, num_images, which):
+        """
+        Get random images from the dataset, e.g. to track the progress of a generator on them.
+        Iterable (streaming) datasets give their first `num_images` samples instead.
+
+        Args:
+            num_images: Number of images.
+            which: Which images of the samples, e.g. "before" or "after".
+
+        Returns:
+            The images as one batch on the trainer's device.
+        """
+
+        if isinstance(self.dataset, torch.utils.data.IterableDataset):
+            samples = itertools.islice(iter(self.dataset), num_images)
+        else:
+            random_indices = random.sample(range(len(self.dataset)), num_images)
+            samples = (self.dataset[i] for i in random_indices)
+
+        return torch.stack([sample[which] for sample in samples], dim=0).to(self.device)
 
 
     def pre_train_step(self):
@@ -221,6 +302,12 @@ class BaseTrainer:
         should_save_progress = self.iters % self.save_interval == 0
         finished_epoch = self.batch == self.num_batches
 
+        # Record how long this iteration waited for data
+        self.add_data(data_wait=self._iter_data_wait_time)
+        if self.writer is not None:
+            self.writer.add_scalar("data_wait", self._iter_data_wait_time, self.iters)
+        self._iter_data_wait_time = 0.0
+
         # Report training stats
         if should_report_stats or finished_epoch:
             self.report_stats()
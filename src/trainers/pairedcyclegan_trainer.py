@@ -1,6 +1,5 @@
 
 import os
-import random
 import torch
 import torch.nn.functional as F
 
@@ -69,14 +68,8 @@ class PairedCycleGANTrainer(BaseTrainer):
         # Generate makeup for a sample no-makeup faces and reference makeup faces
         num_test = 12
         self._generated_grids = []
-        
-        random_indices = random.sample(range(len(self.dataset)), num_test)
-        self._fixed_before = torch.stack(
-            [self.dataset[i]["before"] for i in random_indices], dim=0).to(self.device)
-        
-        random_indices = random.sample(range(len(self.dataset)), num_test)
-        self._fixed_after = torch.stack(
-            [self.dataset[i]["after"] for i in random_indices], dim=0).to(self.device)
+        self._fixed_before = self.get_fixed_images(num_test, "before")
+        self._fixed_after = self.get_fixed_images(num_test, "after")
 
 
     def _get_constants(self,
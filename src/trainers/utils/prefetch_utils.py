@@ -0,0 +1,80 @@
+import queue
+import threading
+
+
+class _RaisedException:
+    """Wraps an exception raised in the background thread, to be re-raised by the consumer."""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class BackgroundPrefetcher:
+    """
+    An iterator that consumes another iterator in a background thread,
+    keeping up to `depth` items ready in a bounded queue.
+    """
+
+    _END = object()
+
+    def __init__(self, iterator, depth=2):
+        """
+        Initializes BackgroundPrefetcher and starts prefetching.
+
+        Args:
+            iterator: The iterator to be prefetched.
+            depth: Maximum number of items prefetched ahead of the consumer.
+        """
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop_event = threading.Event()
+        self._exhausted = False
+        self._thread = threading.Thread(target=self._prefetch, args=(iterator,), daemon=True)
+        self._thread.start()
+
+
+    def _prefetch(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return  # closed by the consumer
+            self._put(self._END)
+        except Exception as e:
+            self._put(_RaisedException(e))
+
+
+    def _put(self, item):
+        # Wait for a free slot, but give up if the prefetcher is closed
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self._exhausted:
+            raise StopIteration
+
+        item = self._queue.get()
+
+        if item is self._END:
+            self._exhausted = True
+            raise StopIteration
+        if isinstance(item, _RaisedException):
+            self._exhausted = True
+            raise item.exception
+
+        return item
+
+
+    def close(self):
+        """
+        Stops prefetching and waits for the background thread to finish.
+        """
+        self._stop_event.set()
+        self._thread.join()
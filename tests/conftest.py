@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The packages of the repository (e.g. `dataset`) are imported from src, as when running `python -m` from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
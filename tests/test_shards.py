@@ -0,0 +1,66 @@
+import os
+import random
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import torch.utils.data as data_utils
+from dataset import shards
+from dataset.shards import MakeupShardDataset, shuffled, write_shards
+
+
+def make_dataset(dataset_dir, num_before, num_after):
+    """
+    Make a MakeupDataset2 directory of tiny images, whose colors identify them.
+    """
+    for domain, num_images in (("nomakeup", num_before), ("makeup", num_after)):
+        os.makedirs(os.path.join(dataset_dir, domain))
+        for i in range(num_images):
+            color = (i, 0 if domain == "nomakeup" else 255, 0)
+            Image.new("RGB", (4, 4), color).save(os.path.join(dataset_dir, domain, "{:03d}.png".format(i)))
+
+
+def sample_ids(sample):
+    return sample["before"].getpixel((0, 0))[0], sample["after"].getpixel((0, 0))[0]
+
+
+@pytest.mark.parametrize("buffer_size", [-1, 0, 1])
+def test_shuffled_without_buffer(buffer_size):
+    assert list(shuffled(range(10), buffer_size, random.Random(0))) == list(range(10))
+
+
+def test_shuffled_with_buffer():
+    items = list(shuffled(range(100), 10, random.Random(0)))
+    assert sorted(items) == list(range(100))
+
+
+def test_stream_without_shuffling(tmp_path):
+    make_dataset(tmp_path / "dataset", num_before=5, num_after=3)
+    write_shards(tmp_path / "dataset", tmp_path / "shards", shard_size=10)
+
+    dataset = MakeupShardDataset(tmp_path / "shards", shuffle_buffer=0)
+    samples = [sample_ids(sample) for sample in dataset]
+
+    assert [before for before, _ in samples] == list(range(5))
+    assert [after for _, after in samples] == [0, 1, 2, 0, 1]
+
+
+@pytest.mark.parametrize("num_before,num_after", [(12, 3), (3, 12)])
+def test_workers_cover_larger_domain(tmp_path, monkeypatch, num_before, num_after):
+    # More workers than the shards of the smaller domain
+    make_dataset(tmp_path / "dataset", num_before, num_after)
+    write_shards(tmp_path / "dataset", tmp_path / "shards", shard_size=1)
+    num_workers = 6
+
+    samples = []
+    for worker_id in range(num_workers):
+        worker_info = data_utils._utils.worker.WorkerInfo(id=worker_id, num_workers=num_workers, seed=0, dataset=None)
+        monkeypatch.setattr(shards.data_utils, "get_worker_info", lambda: worker_info)
+        samples += [sample_ids(sample) for sample in MakeupShardDataset(tmp_path / "shards")]
+
+    larger, smaller = (0, 1) if num_before >= num_after else (1, 0)
+    assert sorted(sample[larger] for sample in samples) == list(range(max(num_before, num_after)))
+    assert {sample[smaller] for sample in samples} <= set(range(min(num_before, num_after)))